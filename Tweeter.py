@@ -1,14 +1,36 @@
-from InquirerPy import inquirer
-from InquirerPy.base.control import Choice
-from rich import print as rprint
-
-import datetime
-import sqlite3
+import dates
+import metrics
+import schema
+from pager import Pager, offset_pages
+from store import TRENDING_RETENTION_HOURS, TweeterStore
+
+import argparse
+import concurrent.futures
+import csv
+import functools
+import json
+import logging
 import sys
 import os
 import subprocess
 import time
 
+# The terminal UI libraries take most of the startup time, they are imported by load_ui only
+# when the interactive program starts so the other commands start quickly
+inquirer = None
+Choice = None
+rprint = None
+
+
+def load_ui():
+    """
+    Imports InquirerPy and rich for the interactive program
+    """
+    global inquirer, Choice, rprint
+    from InquirerPy import inquirer
+    from InquirerPy.base.control import Choice
+    from rich import print as rprint
+
 
 def clear_console():
     os_name = os.name
@@ -19,17 +41,44 @@ def clear_console():
 
 
 class Tweeter:
-    def __init__(self, target):
+    """
+    The interactive terminal client. Every query and write goes through self.store.
+
+    Top level screens return the next screen to show rather than calling it, and run() shows them in
+    a loop, so a session can move between screens forever without growing the stack. Sub-screens
+    such as show_user_info and tweet_options are called by the screen they belong to and return to it.
+    """
+
+    def __init__(self, target, config=None, metrics=None, prefetch=False):
         '''
-        Creates the target sqlite3 database if it does not already exist. Then establishes the connection to it and the Cursor object.
+        Opens the TweeterStore for the target sqlite3 database, creating it if it does not already exist.
 
             Parameters:
                     target (str): Filename of database that tweeter is being opened on
+                    config (dict): Connection settings, see db.DEFAULT_CONFIG
+                    metrics (metrics.QueryMetrics): Collects the latency of every query, None to not collect
+                    prefetch (bool): Fetch the next page of paginated screens in the background
 
         '''
-        self.conn = sqlite3.connect(target)
-        self.c = self.conn.cursor()
+        if inquirer is None:
+            load_ui()
+        self.store = TweeterStore(target, config=config, metrics=metrics)
         self.user_id = None  # Initialize user_id to None since user is not logged in
+        # One background thread is enough, only the screen being shown prefetches
+        self.prefetcher = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='tweeter-prefetch') if prefetch else None
+
+    def run(self, screen=None):
+        """
+        Shows screens until the user exits, starting from the start screen
+
+        Parameters:
+                screen (callable): Screen to start from instead of the start screen
+        """
+        screen = screen or self.start_screen
+        # Each screen returns the next one, None once the program is exiting
+        while screen is not None:
+            screen = screen()
 
     def start_screen(self):
         """
@@ -42,11 +91,11 @@ class Tweeter:
         ).execute()
 
         if result == "Login":
-            self.login()
+            return self.login
         if result == "Sign Up":
-            self.sign_up()
+            return self.sign_up
         if result == "Exit":
-            self.quit()
+            return self.quit
 
     def login(self):
         """Prompts the user for their user id and password then checks if the entered values
@@ -60,22 +109,16 @@ class Tweeter:
             message="Enter Password: "
         ).execute()
 
-        # Check if user_id and password pair is in users table
-        self.c.execute(
-            """SELECT usr FROM users WHERE usr = ? AND pwd = ?;""", (
-                user_id, password)
-        )
-
         # No user was found with matching user_id and password
-        if self.c.fetchone() is None:
+        if not self.store.check_login(user_id, password):
             rprint("[red]ERROR: Incorrect User Id or Password[red]\n")
             time.sleep(1)
-            self.start_screen()
+            return self.start_screen
 
         # If the user id and password match a row in the users table
         else:
-            self.user_id = user_id
-            self.follow_feed()
+            self.user_id = int(user_id)
+            return self.follow_feed
 
     def sign_up(self):
         """Prompts the user to enter their name, email, city, timezone and password then generates
@@ -113,66 +156,45 @@ class Tweeter:
             message="Enter Password: "
         ).execute()
 
-        self.insert_user(password, name, email, city, timezone)
-        print(f"Your User Id is: {self.get_next_user_id()-1}")
+        user_id = self.store.insert_user(password, name, email, city, timezone)
+        print(f"Your User Id is: {user_id}")
         time.sleep(2)
 
         # Return to start screen after signing up
-        self.start_screen()
-
-    def get_next_user_id(self):
-        """Generates a new user id based on the largest user id in users table"""
-        self.c.execute(
-            '''SELECT MAX(usr) FROM users''')
-        max_id = self.c.fetchone()[0]
-        next_id = 1 if max_id is None else max_id + 1
-
-        return next_id
-
-    def insert_user(self, pwd, name, email, city, timezone):
-        """
-        Inserts a new user into the users table
-            Parameters:
-                    pwd (str): users password
-                    name (str): users name
-                    email (str): users email
-                    city (str): users city
-                    timezone (float): users timezone
-        """
-        insert_sql = '''INSERT INTO users (usr, pwd, name, email, city, timezone) VALUES (?, ?, ?, ?, ?, ?)'''
-        self.c.execute(insert_sql, (self.get_next_user_id(),
-                                    pwd, name, email, city, timezone))
-        self.conn.commit()
+        return self.start_screen
 
     def quit(self):
-        """Closes the connection to the database and exits the program"""
+        """Closes the connection to the database, there is no next screen so the program exits"""
         clear_console()
         rprint("[red]Exiting now[red]")
         time.sleep(1)
-        self.conn.commit()
-        self.conn.close()
-        exit()
+        if self.prefetcher is not None:
+            self.prefetcher.shutdown(cancel_futures=True)
+        self.store.close()
+        return None
 
     def function_menu(self):
         """Prompts the user to select a system functionality or logout and return to the start menu"""
         clear_console()
         result = inquirer.select(
             message="\nHow would you like to proceed?",
-            choices=["Follow Feed", "Search for tweets", "Search for users",
+            choices=["Follow Feed", "Search for tweets", "Search for users", "Trending",
                      "Compose a tweet", "List followers", "Logout",],).execute()
 
         if result == "Follow Feed":
-            self.follow_feed()
+            return self.follow_feed
         elif result == "Search for tweets":
-            self.search_for_tweets()
+            return self.search_for_tweets
         elif result == "Search for users":
-            self.search_for_users()
+            return self.search_for_users
+        elif result == "Trending":
+            return self.trending
         elif result == "Compose a tweet":
-            self.compose_tweet(return_to=self.function_menu)
+            return functools.partial(self.compose_tweet, return_to=self.function_menu)
         elif result == "List followers":
-            self.list_followers()
+            return self.list_followers
         elif result == "Logout":
-            self.logout()
+            return self.logout
 
     def search_for_users(self, page_size=5):
         '''
@@ -185,30 +207,25 @@ class Tweeter:
             keyword = inquirer.text(
                 message="Enter Keyword: ").execute().strip()
 
-            page = 0
             user_input = ''
+            pager = Pager(offset_pages(lambda page: self.store.search_for_user_query(
+                keyword, offset=page*page_size, page_size=page_size), page_size),
+                first_key=0, executor=self.prefetcher)
 
             while user_input != 'x':
                 clear_console()
-                offset = page*page_size
-                users_found = self.search_for_user_query(
-                    keyword, offset=offset)
+                users_found = pager.rows
 
                 # If no users were found matching the keyword
-                if not users_found and page == 0:
+                if not users_found:
                     print("No users found.")
                     time.sleep(1)
                     break
-                # No more than those displayed on the previous page were found
-                elif not users_found:
-                    print("No more users found")
-                    page -= 1
-                    continue
 
                 choices = []
-                for usr, name, email, city, timezone in users_found:
+                for user in users_found:
                     choices.append(
-                        Choice(usr, f"Name: {name}, Email: {email}, City: {city}, Timezone: {timezone}"))
+                        Choice(user.usr, f"Name: {user.name}, Email: {user.email}, City: {user.city}, Timezone: {user.timezone}"))
 
                 choices.append(Choice('n', "Next Page"))
                 choices.append(Choice('p', "Previous Page"))
@@ -219,54 +236,25 @@ class Tweeter:
 
                 # If user selects a user
                 if user_input.isdigit():
-                    self.show_user_info(int(user_input), name)
+                    names = {user.usr: user.name for user in users_found}
+                    self.show_user_info(int(user_input), names[int(user_input)])
                 # If user wants to see next page
                 elif user_input.lower() == 'n':
-                    page += 1
+                    # No more than those displayed on the current page were found
+                    if not pager.next():
+                        print("No more users found")
+                        time.sleep(1)
                 # If user wants to see previous page
-                elif user_input.lower() == 'p' and page > 0:
-                    page -= 1
+                elif user_input.lower() == 'p':
+                    pager.prev()
                 # If user wants to return to function menu
                 elif user_input.lower() == 'x':
                     break
 
-        self.function_menu()
+            # Stop prefetching pages nobody will see
+            pager.close()
 
-    def search_for_user_query(self, keyword, offset=0):
-        """
-        This performs the query used in search_for_users
-            Parameters:
-                    keyword (str): Keyword entered by user
-                    offset (int): 
-
-            Returns: list of 5 rows from result of query
-            Issues: This combines the queries in python rather than in sql. This may cause performance issues 
-                    with large data sets
-        """
-
-        # Fetch users whose name matches the keyword, sorted by name length
-        self.c.execute("""
-            SELECT usr, name, city, email, timezone
-            FROM users
-            WHERE LOWER(name) LIKE LOWER(?)
-            ORDER BY LENGTH(name) ASC
-        """, ('%'+keyword+'%',))
-        name_matches = self.c.fetchall()
-
-        # Fetch users whose city matches the keyword (and name does not), sorted by city length
-        self.c.execute("""
-            SELECT usr, name, city, email, timezone
-            FROM users
-            WHERE LOWER(city) LIKE LOWER(?) AND LOWER(name) NOT LIKE LOWER(?)
-            ORDER BY LENGTH(city) ASC
-        """, ('%'+keyword+'%', '%'+keyword+'%',))
-        city_matches = self.c.fetchall()
-
-        # Combine the results and apply offset and limit
-        combined_results = name_matches + city_matches
-        limited_results = combined_results[offset:offset+5]
-
-        return limited_results
+        return self.function_menu
 
     def show_user_info(self, user_id, name):
         """
@@ -279,45 +267,22 @@ class Tweeter:
 
         """
 
-        # Get number of tweets by the user
-        tweet_count_query = """SELECT COUNT(*) FROM tweets WHERE writer = ?;"""
-        self.c.execute(tweet_count_query, (user_id,))
-        tweet_count = self.c.fetchone()[0]
-
-        # Get number of users being followed by the user
-        following_count_query = """SELECT COUNT(*) FROM follows WHERE flwer = ?;"""
-        self.c.execute(following_count_query, (user_id,))
-        following_count = self.c.fetchone()[0]
-
-        # Get number of followers for the user
-        follower_count_query = """SELECT COUNT(*) FROM follows WHERE flwee = ?;"""
-        self.c.execute(follower_count_query, (user_id,))
-        follower_count = self.c.fetchone()[0]
-
-        # Get up to three most recent tweets from the user
-        recent_tweets_query = """
-        SELECT tid, text, tdate
-        FROM tweets
-        WHERE writer = ?
-        ORDER BY tdate DESC
-        LIMIT 3;
-        """
-        self.c.execute(recent_tweets_query, (user_id,))
-        recent_tweets = self.c.fetchall()
+        # Tweet, following and follower counts with up to three most recent tweets from the user
+        stats, recent_tweets = self.store.get_profile_card(user_id)
 
         choices = []
         user_input = ''
 
         # Displays tweet stats along with recent tweets and other options
-        choices.append(Choice(None, f"Number of Tweets: {tweet_count}"))
+        choices.append(Choice(None, f"Number of Tweets: {stats.tweets}"))
         choices.append(
-            Choice(None, f"Number of users being followed: {following_count}"))
-        choices.append(Choice(None, f"Number of followers: {follower_count}"))
+            Choice(None, f"Number of users being followed: {stats.following}"))
+        choices.append(Choice(None, f"Number of followers: {stats.followers}"))
 
         # For tweet info in recent tweets add to display
         for tid, text, tdate in recent_tweets:
             choices.append(
-                Choice(tid, f"Tweet ID: {tid}, Date: {tdate}, Text: {text}"))
+                Choice(tid, f"Tweet ID: {tid}, Date: {dates.format_date(tdate)}, Text: {text}"))
 
         # Add navigation options to display
         choices.append(Choice('f', "Follow this user"))
@@ -343,20 +308,14 @@ class Tweeter:
 
     def follow_user(self, follow_user_id):
         """
-        Inserts row into follows with operating user as flwer and selected user as flwee
+        Makes the operating user follow the selected user
 
         Parameters:
                 follow_user_id (int): User id for user being followed
 
         """
-        self.c.execute("""SELECT * FROM follows WHERE flwer = ? AND flwee = ?;""",
-                       (self.user_id, follow_user_id))
-
         # If the operating user is not already following the selected user
-        if self.c.fetchone() is None:
-            self.c.execute("""INSERT INTO follows (flwer, flwee, start_date) VALUES (?, ?, ?);""",
-                           (self.user_id, follow_user_id, datetime.date.today(), ))
-            self.conn.commit()
+        if self.store.follow_user(self.user_id, follow_user_id):
             print(f"You are now following user {follow_user_id}")
         else:
             print(f"{self.user_id} is already following {follow_user_id}")
@@ -364,55 +323,65 @@ class Tweeter:
         # allows user to read result of following user
         time.sleep(1)
 
-    def see_all_tweets(self, user_id):
+    def see_all_tweets(self, user_id, page_size=10):
         """
-        Displays all of selected users tweets 
+        Displays all of selected users tweets a page at a time, only the pages being shown are fetched
         Parameters:
                 user_id (int): Selected users user id
+                page_size (int): How many tweets to display per page
         """
-        tweets_query = """
-        SELECT tid, text, tdate
-        FROM tweets
-        WHERE writer = ?
-        ORDER BY tdate DESC;
-        """
-
-        self.c.execute(tweets_query, (user_id,))
-        tweets = self.c.fetchall()
-
-        choices = []
+        pager = Pager(lambda cursor: self.store.get_user_tweets(
+            user_id, cursor=cursor, page_size=page_size), executor=self.prefetcher)
         user_input = ''
 
-        for tid, text, tdate in tweets:
-            choices.append(
-                Choice(tid, f"Tweet ID: {tid}, Date: {tdate}, Text: {text}"))
-
-        choices.append(Choice('x', "Return to User Info"))
-
         while user_input != 'x':
             clear_console()
+            choices = []
+            for tid, text, tdate in pager.rows:
+                choices.append(
+                    Choice(tid, f"Tweet ID: {tid}, Date: {dates.format_date(tdate)}, Text: {text}"))
+
+            choices.append(Choice('n', "Next Page"))
+            choices.append(Choice('p', "Previous Page"))
+            choices.append(Choice('x', "Return to User Info"))
+
             user_input = str(inquirer.select(message=f"All tweets from user {user_id}",
                                              choices=choices,).execute())
             # If user selects tweet
             if user_input.isdigit():
                 self.tweet_options(int(user_input))
+            # If user wants to see next page
+            elif user_input == 'n':
+                if not pager.next():
+                    print("No more tweets found")
+                    time.sleep(1)
+            # If user wants to see previous page
+            elif user_input == 'p':
+                pager.prev()
             elif user_input == 'x':
                 break
 
-    def tweet_options(self, tweet_id):
+        # Stop prefetching pages nobody will see
+        pager.close()
+
+    def tweet_options(self, tweet_id, in_thread=False):
         """
         Displays actions that user can take on selected tweet
         Parameters:
                 tweet_id (int): tid of selected tweet
+                in_thread (bool): Shown from view_thread, which moves to the tweets thread itself rather than opening another view
+
+        Returns: tid of the tweet whose thread to view next when in_thread, otherwise None
         """
         user_input = ''
         choices = []
 
         while user_input != 'x':
             choices = []
-            stats = self.get_tweet_statistics(tweet_id)
-            choices.append(Choice(None, f"# of Retweets: {stats[0]}"))
-            choices.append(Choice(None, f"# of Replies: {stats[1]}"))
+            stats = self.store.get_tweet_statistics(tweet_id)
+            choices.append(Choice(None, f"# of Retweets: {stats.retweets}"))
+            choices.append(Choice(None, f"# of Replies: {stats.replies}"))
+            choices.append(Choice('thr', "View thread"))
             choices.append(Choice('rep', "Reply to this Tweet"))
             choices.append(Choice('ret', "Retweet this Tweet"))
             choices.append(Choice('x', "Return"))
@@ -420,84 +389,93 @@ class Tweeter:
             user_input = inquirer.select(
                 message="Tweet Stats", choices=choices,).execute()
 
+            # If user wants to see the conversation the tweet is part of
+            if user_input == 'thr':
+                # A thread view already open continues with this tweet, so the screens never nest deeper
+                if in_thread:
+                    return tweet_id
+                self.view_thread(tweet_id)
             # If user wants to compose a tweet replying to seleced tweet
-            if user_input == 'rep':
+            elif user_input == 'rep':
                 self.compose_tweet(replyto=tweet_id)
                 print("Reply Successful")
                 time.sleep(1)
             # If user wants to retweet selected tweet
             elif user_input == 'ret':
-                self.insert_retweet(tweet_id)
-                print("Retweet Successful")
+                if self.store.insert_retweet(self.user_id, tweet_id):
+                    print("Retweet Successful")
+                else:
+                    print("You have already retweeted this tweet")
                 time.sleep(1)
             # If user wants to return to previous screen
             elif user_input == 'x':
                 break
 
-    def get_tweet_statistics(self, tweet_id):
-        """
-        Gets # of retweets and replies for given tweet
-        Parameters:
-                tweet_id (int): tid for given tweet
-
-        Returns:
-                retweets_count (int): # of times given tweet was retweeted
-                replies_count (int): # of times given tweet was replied to
-        """
-        # Count the number of retweets for the given tweet
-        self.c.execute(
-            "SELECT COUNT(*) FROM retweets WHERE tid = ?", (tweet_id,))
-        retweets_count = self.c.fetchone()[0]
-
-        # Count the number of replies for the given tweet
-        self.c.execute(
-            "SELECT COUNT(*) FROM tweets WHERE replyto = ?", (tweet_id,))
-        replies_count = self.c.fetchone()[0]
-
-        return retweets_count, replies_count
-
-    def insert_retweet(self, tweet_id):
-        """
-        inserts a retweet to a given tweet into retweets table
-        """
-        currDate = datetime.date.today()
-
-        self.c.execute("""INSERT INTO retweets (usr, tid, rdate) VALUES (?, ?, ?);""",
-                       (self.user_id, tweet_id, currDate))
-        self.conn.commit()
-
-    def insert_tweet(self, writer, tdate, text, replyto=None):
+    def view_thread(self, tweet_id, depth=3, breadth=5):
         """
-        inserts a tweet into the tweets table and all hashtags into mentions and hashtags table
+        Displays the tweets a tweet replies to and the tree of replies under it. Each tweet starts with
+        up to breadth of its replies shown, more of them are loaded a page at a time when asked for
 
         Parameters:
-                writer (int): User id of tweeting user
-                tdate (date): Date of tweet
-                text (str): tweets text
-                replyto (int): replyto is None if the tweet is not a reply. Otherwise it is tid of tweet being replied to
+                tweet_id (int): tid of the tweet the thread is opened on
+                depth (int): Levels of replies loaded when the thread is opened
+                breadth (int): Replies loaded per tweet at a time
         """
-        next_tweet_id = self.get_next_tweet_id()
-        hashtag_keywords = [word[1:]
-                            for word in text.split() if word.startswith('#')]
-        self.c.execute("""INSERT INTO tweets (tid, writer, tdate, text, replyto) Values (?, ?, ?, ?, ?);""",
-                       (next_tweet_id, writer, tdate, text, replyto,))
-
-        for hashtag in hashtag_keywords:
-            self.c.execute(
-                """SELECT * FROM hashtags WHERE term = ?""", (hashtag,))
-
-            if self.c.fetchone() is None:
-                self.c.execute(
-                    """INSERT INTO hashtags VALUES (?)""", (hashtag,))
+        user_input = ''
+        thread = self.store.get_thread(tweet_id, depth=depth, breadth=breadth)
 
-            self.c.execute(
-                """SELECT * FROM mentions WHERE term = ? AND tid = ?""", (hashtag, next_tweet_id,))
+        while thread and user_input != 'x':
+            ancestors = [row for row in thread if row.depth < 0]
+            tweet = thread[len(ancestors)]
+            # tid -> replies loaded so far, oldest first
+            replies = {}
+            for row in thread[len(ancestors) + 1:]:
+                replies.setdefault(row.replyto, []).append(row)
 
-            if self.c.fetchone() is None:
-                self.c.execute(
-                    """INSERT into mentions VALUES (?, ?)""", (next_tweet_id, hashtag,))
+            while user_input != 'x':
+                clear_console()
+                choices = []
+                for row in ancestors:
+                    choices.append(Choice(
+                        row.tid, f"{row.name}: {row.text} (Date: {dates.format_date(row.tdate)})"))
+
+                # Each tweet is followed by its replies, indented a level, then the option to load more of them
+                stack = [(tweet, 0)]
+                while stack:
+                    row, level = stack.pop()
+                    indent = '    ' * level
+                    if isinstance(row, int):
+                        choices.append(Choice(('more', row), f"{indent}Show more replies"))
+                        continue
+                    choices.append(Choice(
+                        row.tid, f"{indent}{row.name}: {row.text} (Date: {dates.format_date(row.tdate)}, Replies: {row.replies})"))
+                    shown = replies.get(row.tid, [])
+                    if len(shown) < row.replies:
+                        stack.append((row.tid, level + 1))
+                    stack.extend((reply, level + 1) for reply in reversed(shown))
+
+                choices.append(Choice('x', "Return"))
+                user_input = inquirer.select(
+                    message="Thread", choices=choices,).execute()
+
+                # If user wants to load more replies to a tweet
+                if isinstance(user_input, tuple):
+                    shown = replies.setdefault(user_input[1], [])
+                    cursor = (shown[-1].tdate, shown[-1].tid) if shown else None
+                    more, _ = self.store.get_replies(user_input[1], cursor=cursor, page_size=breadth)
+                    shown.extend(more)
+                # If user selected a tweet, reload the thread afterwards in case they replied, or
+                # open the selected tweets thread in this same loop if they asked to view it
+                elif user_input != 'x':
+                    next_tweet_id = self.tweet_options(user_input, in_thread=True)
+                    if next_tweet_id is not None:
+                        tweet_id = next_tweet_id
+                    thread = self.store.get_thread(tweet_id, depth=depth, breadth=breadth)
+                    break
 
-        self.conn.commit()
+        if not thread:
+            print("Tweet not found")
+            time.sleep(1)
 
     def compose_tweet(self, replyto=None, return_to=None):
         """
@@ -505,7 +483,9 @@ class Tweeter:
 
         Parameters:
             replyto (int): tid of tweet being replied to. None if not replying to tweet
-            return_to (callable): If called from function menu return to function menu otherwise return to previous screen
+            return_to (callable): Next screen when shown from the function menu, None when called by the previous screen
+
+        Returns: return_to
         """
         text = None
         # While user does not input valid tweet text
@@ -514,189 +494,163 @@ class Tweeter:
 
             # If user input valid tweet text
             if text is not None:
-                self.insert_tweet(
-                    self.user_id, datetime.date.today(), text, replyto=replyto)
+                self.store.insert_tweet(
+                    self.user_id, dates.now(), text, replyto=replyto)
                 print("Tweet Posted")
                 time.sleep(1)
             else:
                 print("No text entered")
                 time.sleep(1)
 
-        # if called from function menu return to function menu
-        if callable(return_to):
-            return_to()
+        # if shown from function menu the function menu is next
+        return return_to
 
-    def get_next_tweet_id(self):
+    def trending(self, hours=24, limit=20):
         """
-        Generate next tweet id based on max tweet id in tweets table
+        Displays the hashtags mentioned by the most tweets over the last hours, selecting one searches for its tweets
+
+        Parameters:
+                hours (int): How many hours back hashtags are counted
+                limit (int): How many hashtags to display
         """
-        self.c.execute(
-            '''SELECT MAX(tid) FROM tweets''')
-        max_id = self.c.fetchone()[0]
-        next_id = 1 if max_id is None else max_id + 1
+        clear_console()
+        trends = self.store.get_trending(hours=hours, limit=limit)
 
-        return next_id
+        # If no hashtags were used recently
+        if not trends:
+            print(f"No hashtags used in the last {hours} hours")
+            time.sleep(1)
+            return self.function_menu
 
-    def search_for_tweets(self, page_size=5):
+        choices = [Choice(f"#{term}", f"#{term} ({count} tweets)") for term, count in trends]
+        choices.append(Choice('x', "Return to Function Menu"))
+        user_input = inquirer.select(
+            message=f"Trending in the last {hours} hours:", choices=choices).execute()
+
+        if user_input == 'x':
+            return self.function_menu
+        return functools.partial(self.search_for_tweets, keywords=[user_input])
+
+    def search_for_tweets(self, page_size=5, keywords=None):
         """
         Prompts the user to enter keywords. Then parses keywords into hashtags and text_keywords and searches for tweets which contain the text_keywords
         in the tweets.text field.
+
+        Parameters:
+                keywords (list(str)): Keywords to search for instead of prompting, words prefixed with # are hashtags
         """
-        keywords = None
-        # While user has not entered valid keyword(s)
-        while keywords is None:
+        # If the keywords were not given, e.g. by the trending screen
+        if keywords is None:
             keywords = inquirer.text(
                 message="Enter keywords separated by space(prefix with # for hashtags): ").execute().split()
 
-            # If user entered valid keyword(s)
-            if keywords is not None:
-                page = 0
-                user_input = ''
+        # If user entered valid keyword(s)
+        if keywords:
+            user_input = ''
+            choices = []
+
+            hashtag_keywords = [word[1:]
+                                for word in keywords if word.startswith('#')]
+            text_keywords = [
+                word for word in keywords if not word.startswith('#')]
+            pager = Pager(offset_pages(lambda page: self.store.search_for_tweets_query(
+                hashtag_keywords, text_keywords, page=page, page_size=page_size), page_size),
+                first_key=0, executor=self.prefetcher)
+
+            while user_input != 'x':
                 choices = []
+                clear_console()
+                tweets = pager.rows
 
-                hashtag_keywords = [word[1:]
-                                    for word in keywords if word.startswith('#')]
-                text_keywords = [
-                    word for word in keywords if not word.startswith('#')]
+                # If no tweets found matching keywords
+                if not tweets:
+                    print("No tweets found")
+                    time.sleep(1)
+                    break
 
-                while user_input != 'x':
-                    choices = []
-                    clear_console()
-                    tweets = self.search_for_tweets_query(
-                        hashtag_keywords, text_keywords, page=page, page_size=page_size)
+                for tid, text, tdate, name, in tweets:
+                    choices.append(
+                        Choice(tid, f"Writer: {name}, Date: {dates.format_date(tdate)}, Text: {text}"))
 
-                    # If no tweets found matching keywords
-                    if not tweets and page == 0:
-                        print("No tweets found")
-                        time.sleep(1)
-                        break
+                choices.append(Choice('n', "Next Page"))
+                choices.append(Choice('p', "Previous Page"))
+                choices.append(Choice('x', "Return to Function Menu"))
 
+                user_input = str(inquirer.select(
+                    message="Tweets Found:", choices=choices).execute())
+
+                # If user selects a tweet
+                if user_input.isdigit():
+                    self.tweet_options(int(user_input))
+                    # A reply or retweet may have changed the results
+                    pager.refresh()
+                # If user wants to see next page
+                elif user_input == 'n':
                     # If no more tweets found
-                    elif not tweets:
+                    if not pager.next():
                         print("No more tweets found")
                         time.sleep(1)
-                        page -= 1
-                        continue
-
-                    for tid, text, tdate, name, in tweets:
-                        choices.append(
-                            Choice(tid, f"Writer: {name}, Date: {tdate}, Text: {text}"))
-
-                    choices.append(Choice('n', "Next Page"))
-                    choices.append(Choice('p', "Previous Page"))
-                    choices.append(Choice('x', "Return to Function Menu"))
-
-                    user_input = str(inquirer.select(
-                        message="Tweets Found:", choices=choices).execute())
-
-                    # If user selects a tweet
-                    if user_input.isdigit():
-                        self.tweet_options(int(user_input))
-                    # If user wants to see next page
-                    elif user_input == 'n':
-                        page += 1
-                    # If user wants to see previous page and not on first page
-                    elif user_input == 'p' and page > 0:
-                        page -= 1
-                    # If user wants to return to function menu
-                    elif user_input == 'x':
-                        break
-        self.function_menu()
-
-    def search_for_tweets_query(self, hashtag_keywords, text_keywords, page=0, page_size=5):
-        """
-        Query for search_for tweets
+                # If user wants to see previous page and not on first page
+                elif user_input == 'p':
+                    pager.prev()
+                # If user wants to return to function menu
+                elif user_input == 'x':
+                    break
 
-        Parameters:
-                hashtag_keywords (list(str)): hashtags being searched for
-                text_keywords (list(str)): text keywords being searched for
-                page (int): current page
-                page_size (int): How many tweets to display per page
+            # Stop prefetching pages nobody will see
+            pager.close()
+        return self.function_menu
 
-        Returns:
-            tweets (list(tuple(int, str, date))): Tweets found matching keywords
-        """
-        offset = page * page_size
-        # Create dynamic query parts based on keywords
-        hashtag_query_parts = [
-            "SELECT tid FROM mentions WHERE LOWER(term) = LOWER(?)"]
-        text_query_parts = [
-            "SELECT tid FROM tweets WHERE LOWER(text) LIKE LOWER(?)"]
-
-        # Combine query parts with bind parameters
-        query_parts = []
-        params = []
-        if text_keywords:
-            query_parts.extend(text_query_parts * len(text_keywords))
-            params.extend([f'%{keyword}%' for keyword in text_keywords])
-
-        if hashtag_keywords:
-            query_parts.extend(hashtag_query_parts * len(hashtag_keywords))
-            params.extend(hashtag_keywords)
-
-        combined_query_part = " UNION ".join(query_parts)
-
-        # Combined query
-        combined_query = f"""
-        SELECT tid, text, tdate, name
-        FROM tweets, users
-        WHERE tid IN (
-            {combined_query_part}
-        ) AND writer = usr
-        ORDER BY tdate DESC
-        LIMIT 5 OFFSET ?;
+    def list_followers(self, page_size=10):
         """
-        params.append(offset)
+        Displays all users following operating user a page at a time, only the pages being shown are fetched
 
-        self.c.execute(combined_query, params)
-        tweets = self.c.fetchall()
-        return tweets
-
-    def list_followers(self):
-        """
-        Displays all users following operating user
+        Parameters:
+                page_size (int): How many followers to display per page
         """
         clear_console()
         user_input = ''
-        choices = []
-        followers = self.get_followers()
+        pager = Pager(lambda cursor: self.store.get_followers(
+            self.user_id, cursor=cursor, page_size=page_size), executor=self.prefetcher)
 
         # If no followers found
-        if not followers:
+        if not pager.rows:
             print("You have no followers")
             time.sleep(1)
 
-        else:
-
-            for usr, name, email, city, timezone, start_date in followers:
+        while pager.rows and user_input != 'x':
+            clear_console()
+            choices = []
+            for follower in pager.rows:
                 choices.append(Choice(
-                    usr, f"Name: {name}, Email: {email}, City: {city}, Timezone: {timezone}, Following Since: {start_date}"))
+                    follower.usr, f"Name: {follower.name}, Email: {follower.email}, City: {follower.city}, Timezone: {follower.timezone}, Following Since: {dates.format_date(follower.start_date)}"))
 
+            choices.append(Choice('n', "Next Page"))
+            choices.append(Choice('p', "Previous Page"))
             choices.append(Choice('x', "Return to Function Menu"))
 
-            while user_input != 'x':
-                clear_console()
-                user_input = str(inquirer.select(
-                    message="Your Followers:", choices=choices).execute())
-
-                # If user selects a one of their followers
-                if user_input.isdigit():
-                    self.show_user_info(int(user_input), name)
-                # If user wants to return to function menu
-                elif user_input == 'x':
-                    break
-
-        self.function_menu()
+            user_input = str(inquirer.select(
+                message="Your Followers:", choices=choices).execute())
 
-    def get_followers(self):
-        """
-        Query for list_followers
+            # If user selects a one of their followers
+            if user_input.isdigit():
+                names = {follower.usr: follower.name for follower in pager.rows}
+                self.show_user_info(int(user_input), names[int(user_input)])
+            # If user wants to see next page
+            elif user_input == 'n':
+                if not pager.next():
+                    print("No more followers found")
+                    time.sleep(1)
+            # If user wants to see previous page
+            elif user_input == 'p':
+                pager.prev()
+            # If user wants to return to function menu
+            elif user_input == 'x':
+                break
 
-        Returns: list of users following operating user and when they started following
-        """
-        self.c.execute(
-            """SELECT usr, name, email, city, timezone, start_date FROM users, follows WHERE flwee = ? AND flwer = usr;""", (self.user_id,))
-        return self.c.fetchall()
+        # Stop prefetching pages nobody will see
+        pager.close()
+        return self.function_menu
 
     def logout(self):
         """
@@ -705,7 +659,7 @@ class Tweeter:
         self.user_id = None
         print("You have logged out")
         time.sleep(1)
-        self.start_screen()
+        return self.start_screen
 
     def follow_feed(self, page_size=5):
         """
@@ -714,29 +668,25 @@ class Tweeter:
         Parameters:
                 page_size (int): How many results to display per page
         """
-        page = 0
+        # Pages are keyed by the cursor the feed query continues from, the first page has none
+        pager = Pager(lambda cursor: self.store.get_follow_feed_tweets(
+            self.user_id, cursor=cursor, page_size=page_size), executor=self.prefetcher)
         user_input = ''
         choices = []
 
         while user_input != 'x':
             clear_console()
             choices = []
-            tweets = self.get_follow_feed_tweets(
-                page=page, page_size=page_size)
+            tweets = pager.rows
 
-            if not tweets and page == 0:
+            if not tweets:
                 print("No tweets found in your Follow Feed")
                 time.sleep(1)
                 break
-            elif not tweets:
-                print("No more tweets found")
-                time.sleep(1)
-                page -= 1
-                continue
 
             for tid, replyto, text, tdate, tweet_type, author in tweets:
                 choices.append(Choice(
-                    tid, f"{author} Replying to {replyto}: {text} (Date: {tdate}, Type: {tweet_type}, Author: {author})"))
+                    tid, f"{author} Replying to {replyto}: {text} (Date: {dates.format_date(tdate)}, Type: {tweet_type}, Author: {author})"))
             choices.append(Choice('n', "Next Page"))
             choices.append(Choice('p', "Previous Page"))
             choices.append(Choice('x', "Continue to Function Menu"))
@@ -748,41 +698,361 @@ class Tweeter:
             if user_input.isdigit():
                 # Display options for selected tweet or original tweet if user selected a retweet
                 self.tweet_options(int(user_input))
+                # Show the latest version of the page after returning from the tweet
+                pager.refresh()
             # If user wants to see next page
             elif user_input == 'n':
-                page += 1
+                if not pager.next():
+                    print("No more tweets found")
+                    time.sleep(1)
             # If user wants to see previous page and not on first page
-            elif user_input == 'p' and page > 0:
-                page -= 1
+            elif user_input == 'p':
+                pager.prev()
             # If user wants to continue to function menu
             elif user_input == 'x':
                 break
 
-        self.function_menu()
+        # Stop prefetching pages nobody will see
+        pager.close()
+        return self.function_menu
+
+
+def read_tweet_file(file):
+    """
+    Reads tweets for insert_tweets from a JSONL file, one object per line, or a CSV file with a header row.
+    Both use the fields writer, tdate, text and replyto, replyto may be missing or empty. tdate is epoch
+    seconds or an ISO 8601 date or date and time.
+
+    Parameters:
+            file (file): Open JSONL or CSV file
+
+    Returns: generator of (writer, tdate, text, replyto) tuples
+    """
+    if file.name.endswith('.csv'):
+        records = csv.DictReader(file)
+    else:
+        records = (json.loads(line) for line in file if line.strip())
+
+    for record in records:
+        replyto = record.get('replyto')
+        yield (int(record['writer']), record['tdate'], record['text'],
+               int(replyto) if replyto not in (None, '') else None)
+
+
+def print_rows(rows, as_json=False):
+    """
+    Prints rows as they are fetched, one JSON object per line or one tab separated line per row.
+    JSON dates are epoch seconds, tab separated dates are formatted as local time
+
+    Parameters:
+            rows (iterable(NamedTuple)): Rows returned by TweeterStore
+            as_json (bool): Print JSON lines instead of tab separated values
+    """
+    for row in rows:
+        if as_json:
+            print(json.dumps(row._asdict(), default=str))
+        else:
+            print('\t'.join('' if value is None else str(value) for value in dates.format_row(row)))
+
+
+def paged_rows(fetch_page, limit, page_size=100):
+    """
+    Yields up to limit rows from a query taking a page number and page size, one page at a time
+
+    Parameters:
+            fetch_page (callable): Called with (page, page_size), returns a list of rows
+            limit (int): Most rows yielded
+            page_size (int): Most rows fetched per query
+    """
+    page_size = min(page_size, limit)
+    page = 0
+    while limit > 0:
+        rows = fetch_page(page, page_size)
+        yield from rows[:limit]
+        limit -= len(rows)
+        if len(rows) < page_size:
+            return
+        page += 1
+
+
+def feed_rows(store, user_id, limit, page_size=100):
+    """
+    Yields up to limit rows of a users follow feed, following the feed cursor one page at a time
+    """
+    cursor = None
+    while limit > 0:
+        rows, cursor = store.get_follow_feed_tweets(user_id, cursor=cursor, page_size=min(page_size, limit))
+        yield from rows
+        limit -= len(rows)
+        if cursor is None:
+            return
+
+
+def main(argv=None):
+    """
+    Parses the command line and either runs a maintenance command or starts the interactive program
+    """
+    parser = argparse.ArgumentParser(description="Tweeter")
+    parser.add_argument('database', help="Filename of the sqlite3 database")
+    parser.add_argument('--config', help="JSON file of connection settings, see db.DEFAULT_CONFIG")
+    parser.add_argument('--metrics', help="Collect query latencies and save them to this file on exit, "
+                                          "in the Prometheus text format if it ends in .prom and as JSON otherwise")
+    parser.add_argument('--slow-query-ms', type=float, default=100,
+                        help="Log queries slower than this with their plan, only when collecting metrics")
+    parser.add_argument('--query-log', help="File slow queries are logged to, standard error by default")
+    parser.add_argument('--trace-sql', action='store_true',
+                        help="Log every statement sqlite runs, only when collecting metrics")
+    parser.add_argument('--prefetch', action='store_true',
+                        help="Fetch the next page of the feed and searches while the current page is shown")
+    parser.add_argument('--count-vm-steps', type=int, metavar='N',
+                        help="Count sqlite virtual machine steps per method in batches of N")
+    commands = parser.add_subparsers(dest='command')
+
+    rebuild_parser = commands.add_parser(
+        'rebuild-timeline', help="Regenerate the timeline table and enable fan-out-on-write")
+    rebuild_parser.add_argument('--cap', type=int,
+                                help="Most entries kept per follower, kept for every later session. "
+                                     "The cap of the last rebuild by default, 800 the first time")
+
+    commands.add_parser(
+        'build-search-index', help="Build the full-text indexes used by tweet and user searches")
+
+    stats_parser = commands.add_parser(
+        'verify-stats', help="Check the user and tweet statistics counters against the base tables")
+    stats_parser.add_argument('--repair', action='store_true',
+                              help="Build the counters if needed and fix any wrong ones")
+
+    import_parser = commands.add_parser(
+        'import-tweets', help="Bulk load tweets from a JSONL or CSV file with writer, tdate, text and replyto fields")
+    import_parser.add_argument('file', help="A .jsonl or .csv file")
+    import_parser.add_argument('--chunk-size', type=int, default=1000,
+                               help="How many tweets are written per transaction")
+
+    generate_parser = commands.add_parser(
+        'generate', help="Fill the database with synthetic users, follows, tweets and retweets")
+    generate_parser.add_argument('--tweets', type=int, default=10000)
+    generate_parser.add_argument('--users', type=int, help="Defaults to one user per 20 tweets")
+    generate_parser.add_argument('--follows-per-user', type=int, default=20)
+    generate_parser.add_argument('--seed', type=int, default=0)
+    generate_parser.add_argument('--end', help="When the generated dates end, epoch seconds or an ISO date "
+                                               "such as 2024-06-30. 2024-01-01 00:00 UTC by default")
+
+    compact_parser = commands.add_parser(
+        'compact-trending', help="Delete hourly hashtag counters older than every trending window")
+    compact_parser.add_argument('--retention-hours', type=int, default=TRENDING_RETENTION_HOURS)
+
+    commands.add_parser(
+        'migrate', help="Upgrade the database schema in place, including converting dates to epoch seconds")
+
+    commands.add_parser(
+        'check-plans', help="Fail if any query used by Tweeter scans a whole table")
+
+    # Options shared by the commands that print query results
+    output_parser = argparse.ArgumentParser(add_help=False)
+    output_parser.add_argument('--json', action='store_true', help="Print one JSON object per line")
+
+    feed_parser = commands.add_parser(
+        'feed', parents=[output_parser], help="Print a user's follow feed, newest first")
+    feed_parser.add_argument('--user', type=int, required=True)
+    feed_parser.add_argument('--limit', type=int, default=50)
+
+    search_tweets_parser = commands.add_parser(
+        'search-tweets', parents=[output_parser], help="Print tweets matching keywords, prefix hashtags with #")
+    search_tweets_parser.add_argument('keywords', nargs='+')
+    search_tweets_parser.add_argument('--limit', type=int, default=50)
+    search_tweets_parser.add_argument('--order', choices=['date', 'rank'], default='date')
+
+    search_users_parser = commands.add_parser(
+        'search-users', parents=[output_parser], help="Print users whose name or city contains a keyword")
+    search_users_parser.add_argument('keyword')
+    search_users_parser.add_argument('--limit', type=int, default=50)
+
+    query_stats_parser = commands.add_parser(
+        'stats', parents=[output_parser], help="Print the statistics of a user or a tweet")
+    stats_target = query_stats_parser.add_mutually_exclusive_group(required=True)
+    stats_target.add_argument('--user', type=int, help="Print # of tweets, users followed and followers")
+    stats_target.add_argument('--tid', type=int, help="Print # of retweets and replies")
+
+    trending_parser = commands.add_parser(
+        'trending', parents=[output_parser], help="Print the hashtags mentioned by the most tweets recently")
+    trending_parser.add_argument('--hours', type=int, default=24)
+    trending_parser.add_argument('--limit', type=int, default=20)
+
+    post_parser = commands.add_parser(
+        'post', parents=[output_parser], help="Post a tweet as a user and print its tid")
+    post_parser.add_argument('--user', type=int, required=True)
+    post_parser.add_argument('--text', required=True)
+    post_parser.add_argument('--replyto', type=int, help="tid of the tweet being replied to")
+
+    serve_parser = commands.add_parser(
+        'serve', help="Serve many sessions over a local socket, one JSON request per line")
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8291)
+    serve_parser.add_argument('--workers', type=int, default=8,
+                              help="Most database calls running at once")
+    serve_parser.add_argument('--durability', choices=('immediate', 'grouped', 'relaxed'), default='grouped',
+                              help="immediate commits every write on its own, grouped commits writes in batches and "
+                                   "acknowledges them once committed, both sync every commit to disk. relaxed acknowledges "
+                                   "writes before their batch commits")
+    serve_parser.add_argument('--batch-size', type=int, default=64,
+                              help="Most writes committed in one transaction")
+    serve_parser.add_argument('--batch-ms', type=float, default=2.0,
+                              help="Milliseconds a batch waits for more writes after its first one")
+    serve_parser.add_argument('--compact-minutes', type=float, default=60,
+                              help="Minutes between deleting hashtag counters older than every trending window")
+
+    args = parser.parse_args(argv)
+
+    config = None
+    if args.config:
+        with open(args.config) as file:
+            config = json.load(file)
+
+    if args.command == 'rebuild-timeline':
+        store = TweeterStore(args.database, config=config)
+        store.rebuild_timeline(cap=args.cap)
+        print("Timeline rebuilt")
+        return
+
+    if args.command == 'build-search-index':
+        store = TweeterStore(args.database, config=config)
+        if store.build_search_index():
+            print("Search index built")
+        else:
+            print("This SQLite build does not support FTS5, searches will keep using LIKE")
+        return
+
+    if args.command == 'verify-stats':
+        store = TweeterStore(args.database, config=config)
+        if not store.stats and not args.repair:
+            print("The counters have not been built, run verify-stats --repair to build them")
+            return
+        wrong = store.verify_stats(repair=args.repair)
+        if args.repair:
+            print(f"Repaired {wrong} wrong or missing counters")
+        else:
+            print(f"Found {wrong} wrong or missing counters")
+        return
+
+    if args.command == 'import-tweets':
+        store = TweeterStore(args.database, config=config)
+        with open(args.file, newline='') as file:
+            inserted = store.insert_tweets(
+                read_tweet_file(file), chunk_size=args.chunk_size,
+                progress=lambda count, rate: print(f"{count} tweets inserted ({rate:.0f} tweets/s)"))
+        print(f"Imported {inserted} tweets")
+        return
+
+    if args.command == 'generate':
+        import datagen
+
+        store = TweeterStore(args.database, config=config)
+        counts = datagen.generate(store, tweets=args.tweets, users=args.users,
+                                  follows_per_user=args.follows_per_user, seed=args.seed,
+                                  end=datagen.DEFAULT_END if args.end is None else args.end,
+                                  progress=lambda message: print(f"Generated {message}"))
+        store.close()
+        print(f"Generated {sum(counts.values())} rows")
+        return
+
+    if args.command == 'compact-trending':
+        store = TweeterStore(args.database, config=config)
+        print(f"Deleted {store.compact_trending(args.retention_hours)} hashtag counters")
+        store.close()
+        return
+
+    if args.command == 'migrate':
+        # Opening the store applies every migration the database has not had yet
+        store = TweeterStore(args.database, config=config)
+        print(f"Database is at schema version {schema.get_version(store.conn)}")
+        store.close()
+        return
+
+    if args.command == 'check-plans':
+        store = TweeterStore(args.database, config=config)
+        try:
+            store.check_query_plans()
+        except schema.QueryPlanError as error:
+            print(f"Full table scans found:\n\n{error}")
+            if not (store.fts and store.user_fts):
+                print("\nSearches scan tweets and users until build-search-index has been run")
+            sys.exit(1)
+        print("No query scans a whole table")
+        return
+
+    query_metrics = None
+    if args.metrics:
+        logging.basicConfig(filename=args.query_log, level=logging.DEBUG if args.trace_sql else logging.WARNING,
+                            format="%(asctime)s %(message)s")
+        query_metrics = metrics.QueryMetrics(
+            slow_threshold=args.slow_query_ms / 1000, trace=args.trace_sql, progress_steps=args.count_vm_steps)
+
+    try:
+        if args.command == 'feed':
+            store = TweeterStore(args.database, config=config, metrics=query_metrics)
+            print_rows(feed_rows(store, args.user, args.limit), args.json)
+            return
+
+        if args.command == 'search-tweets':
+            store = TweeterStore(args.database, config=config, metrics=query_metrics)
+            hashtag_keywords = [word[1:] for word in args.keywords if word.startswith('#')]
+            text_keywords = [word for word in args.keywords if not word.startswith('#')]
+            print_rows(paged_rows(lambda page, page_size: store.search_for_tweets_query(
+                hashtag_keywords, text_keywords, page=page, page_size=page_size, order=args.order),
+                args.limit), args.json)
+            return
+
+        if args.command == 'search-users':
+            store = TweeterStore(args.database, config=config, metrics=query_metrics)
+            print_rows(paged_rows(lambda page, page_size: store.search_for_user_query(
+                args.keyword, offset=page * page_size, page_size=page_size), args.limit), args.json)
+            return
+
+        if args.command == 'stats':
+            store = TweeterStore(args.database, config=config, metrics=query_metrics)
+            if args.user is not None:
+                print_rows([store.get_user_statistics(args.user)], args.json)
+            else:
+                print_rows([store.get_tweet_statistics(args.tid)], args.json)
+            return
+
+        if args.command == 'trending':
+            store = TweeterStore(args.database, config=config, metrics=query_metrics)
+            print_rows(store.get_trending(hours=args.hours, limit=args.limit), args.json)
+            return
+
+        if args.command == 'post':
+            store = TweeterStore(args.database, config=config, metrics=query_metrics)
+            tid = store.insert_tweet(args.user, dates.now(), args.text, replyto=args.replyto)
+            store.close()
+            print(json.dumps({'tid': tid}) if args.json else tid)
+            return
+
+        if args.command == 'serve':
+            # asyncio is only needed by the server
+            import asyncio
+            from server import TweeterServer
+            from writequeue import WriteQueue
+
+            store = TweeterStore(args.database, config=config, metrics=query_metrics)
+            writes = WriteQueue(store, durability=args.durability,
+                                max_batch=args.batch_size, max_delay=args.batch_ms / 1000)
+            server = TweeterServer(store, workers=args.workers, writes=writes)
+            try:
+                asyncio.run(server.serve(args.host, args.port, compact_interval=args.compact_minutes * 60))
+            except KeyboardInterrupt:
+                pass
+            finally:
+                server.close()
+                store.close()
+            return
 
-    def get_follow_feed_tweets(self, page=0, page_size=5):
-        """
-        Query for follow_feed
-        """
-        offset = page * page_size
-        self.c.execute("""
-            SELECT id, replyto, text, date, type, author FROM (
-                SELECT tweets.tid AS id, tweets.text, tweets.tdate AS date, 'tweet' AS type, tweets.writer AS author, replyto
-                FROM tweets
-                INNER JOIN follows ON tweets.writer = follows.flwee
-                WHERE follows.flwer = ?
-                UNION ALL
-                SELECT tweets.tid AS id, tweets.text, retweets.rdate AS date, 'retweet' AS type, retweets.usr AS author, NULL as replyto
-                FROM retweets
-                INNER JOIN tweets ON retweets.tid = tweets.tid
-                INNER JOIN follows ON retweets.usr = follows.flwee
-                WHERE follows.flwer = ?
-            ) ORDER BY date DESC LIMIT ? OFFSET ?;
-        """, (self.user_id, self.user_id, page_size, offset))
-        return self.c.fetchall()
+        tweeter = Tweeter(args.database, config=config, metrics=query_metrics, prefetch=args.prefetch)
+        tweeter.run()
+    finally:
+        if query_metrics is not None:
+            query_metrics.write(args.metrics)
 
 
 if __name__ == "__main__":
-
-    tweeter = Tweeter(str(sys.argv[1]))
-    tweeter.start_screen()
+    main()
@@ -0,0 +1,227 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import time
+
+import datagen
+from store import TweeterStore
+
+
+def percentile(timings, fraction):
+    """
+    Returns the timing below which the given fraction of timings fall, using the nearest rank
+    """
+    ordered = sorted(timings)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(timings):
+    """
+    Returns the latency percentiles of a list of timings in seconds, in milliseconds
+    """
+    return {
+        'n': len(timings),
+        'mean_ms': statistics.fmean(timings) * 1000,
+        'p50_ms': percentile(timings, 0.50) * 1000,
+        'p95_ms': percentile(timings, 0.95) * 1000,
+        'p99_ms': percentile(timings, 0.99) * 1000,
+    }
+
+
+def feed_walk(store, user_id, pages=10):
+    """
+    Pages through the first pages of a follow feed the way the feed screen does
+    """
+    cursor = None
+    for _ in range(pages):
+        rows, cursor = store.get_follow_feed_tweets(user_id, cursor=cursor)
+        if cursor is None:
+            break
+
+
+# Config of the store the workloads are timed on. Caches are off so every run measures the query
+UNCACHED = {'cache_entries': 0, 'search_cache_entries': 0}
+
+# Workloads served from the caches, also timed with the caches on as <name>_cached
+CACHED_WORKLOADS = ('search_tweets_text', 'search_tweets_hashtag', 'search_tweets_mixed', 'show_user_info',
+                    'tweet_stats')
+
+
+def workloads(store, rng):
+    """
+    Returns (name, zero argument callable) pairs, each call runs one operation with random inputs
+    drawn from the generated data
+    """
+    first_user, last_user = store.conn.execute("SELECT MIN(usr), MAX(usr) FROM users;").fetchone()
+    first_tid, last_tid = store.conn.execute("SELECT MIN(tid), MAX(tid) FROM tweets;").fetchone()
+
+    def user():
+        return rng.randint(first_user, last_user)
+
+    def word():
+        # Skip the most common words, nobody searches for "the"
+        return rng.choice(datagen.WORDS[20:])
+
+    return [
+        ('feed_first_page', lambda: store.get_follow_feed_tweets(user())),
+        ('feed_ten_pages', lambda: feed_walk(store, user())),
+        ('search_tweets_text', lambda: store.search_for_tweets_query([], [word()])),
+        ('search_tweets_hashtag', lambda: store.search_for_tweets_query([rng.choice(datagen.HASHTAGS)], [])),
+        ('search_tweets_mixed', lambda: store.search_for_tweets_query(
+            [rng.choice(datagen.HASHTAGS)], [word(), word()])),
+        ('search_users', lambda: store.search_for_user_query(
+            rng.choice(datagen.FIRST_NAMES + datagen.CITIES).lower())),
+        ('show_user_info', lambda: store.get_profile_card(user())),
+        ('tweet_stats', lambda: store.get_tweet_statistics(rng.randint(first_tid, last_tid))),
+        ('followers', lambda: store.get_followers(user())),
+    ]
+
+
+def run_size(path, tweets, seed=0, end=datagen.DEFAULT_END, repeat=200, features=(), progress=None):
+    """
+    Times every workload against a generated database with the given number of tweets. The
+    database is generated on the first run and reused by later runs with the same size, seed and end.
+    Workloads are timed with the caches off, and those the caches serve again with them on.
+
+        Parameters:
+                path (str): Filename of the database
+                tweets (int): How many tweets the database has
+                seed (int): Seed used to generate the data and pick query inputs
+                end (int): Epoch time the generated dates end at
+                repeat (int): How many times each workload runs
+                features (iterable(str)): Optional structures to build: 'fts', 'stats' and 'timeline'
+                progress (callable): Called with a message as each step finishes
+
+        Returns: dict of workload name -> latency summary, cached timings named <name>_cached
+    """
+    store = TweeterStore(path)
+    try:
+        if store.conn.execute("SELECT COUNT(*) FROM tweets;").fetchone()[0] == 0:
+            counts = datagen.generate(store, tweets=tweets, seed=seed, end=end, progress=progress)
+            if callable(progress):
+                progress(f"Generated {counts}")
+        if 'fts' in features and not store.fts:
+            store.build_search_index()
+        if 'stats' in features and not store.stats:
+            store.verify_stats(repair=True)
+        if 'timeline' in features and not store.fanout:
+            store.rebuild_timeline()
+        store.conn.execute("ANALYZE;")
+        store.conn.commit()
+    finally:
+        store.close()
+
+    results = {}
+    # Each pass opens its own store, so the cached pass starts from empty caches
+    for config, suffix, names in ((UNCACHED, '', None), (None, '_cached', CACHED_WORKLOADS)):
+        store = TweeterStore(path, config=config)
+        try:
+            rng = random.Random(seed)
+            for name, workload in workloads(store, rng):
+                if names is not None and name not in names:
+                    continue
+                name += suffix
+                results[name] = time_workload(workload, repeat)
+                if callable(progress):
+                    progress(f"{name}: p50 {results[name]['p50_ms']:.2f} ms, p99 {results[name]['p99_ms']:.2f} ms")
+        finally:
+            store.close()
+    return results
+
+
+def time_workload(workload, repeat):
+    """
+    Runs a workload repeat times and returns the latency summary
+    """
+    # One untimed run warms the page cache so the first timing is not an outlier
+    workload()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        workload()
+        timings.append(time.perf_counter() - start)
+    return summarize(timings)
+
+
+def git_commit():
+    """
+    Returns the commit being benchmarked, None outside a git checkout
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """
+    Prints how each p50 and p99 changed from a baseline benchmark run
+    """
+    for size, workloads in results['sizes'].items():
+        for name, summary in workloads.items():
+            before = baseline.get('sizes', {}).get(size, {}).get(name)
+            if before is None:
+                continue
+            changes = ', '.join(
+                f"{key[:3]} {before[key]:.2f} -> {summary[key]:.2f} ms ({summary[key] / before[key]:.2f}x)"
+                for key in ('p50_ms', 'p99_ms') if before[key])
+            print(f"{size:>10} {name:<28} {changes}")
+
+
+def main(argv=None):
+    """
+    Parses the command line and benchmarks every size asked for
+    """
+    parser = argparse.ArgumentParser(
+        description="Time Tweeter's queries against generated databases of several sizes")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000],
+                        help="Tweet counts of the generated databases")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--end', type=int, default=datagen.DEFAULT_END,
+                        help="Epoch time the generated dates end at, keep it fixed to compare runs")
+    parser.add_argument('--repeat', type=int, default=200, help="Runs of each query per size")
+    parser.add_argument('--features', nargs='*', default=[], choices=['fts', 'stats', 'timeline'],
+                        help="Optional structures to build before timing")
+    parser.add_argument('--dir', default='bench', help="Directory the generated databases are kept in")
+    parser.add_argument('--output', default='bench_output.json', help="JSON file the results are saved to")
+    parser.add_argument('--compare', help="JSON results of an earlier run to compare against")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.dir, exist_ok=True)
+    results = {
+        'commit': git_commit(),
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'seed': args.seed,
+        'end': args.end,
+        'features': sorted(args.features),
+        'sizes': {},
+    }
+    for size in args.sizes:
+        print(f"{size} tweets")
+        # Each feature set gets its own database, built structures are kept between runs
+        name = '-'.join([f"tweets-{size}-seed{args.seed}-end{args.end}"] + sorted(args.features))
+        path = os.path.join(args.dir, name + '.db')
+        results['sizes'][str(size)] = run_size(
+            path, size, seed=args.seed, end=args.end, repeat=args.repeat, features=args.features,
+            progress=lambda message: print(f"  {message}"))
+
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f"Results saved to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            compare(results, json.load(file))
+
+
+if __name__ == "__main__":
+    main()
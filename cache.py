@@ -0,0 +1,104 @@
+import collections
+import threading
+import time
+
+
+class LRUCache:
+    """
+    Thread-safe cache of at most max_entries values that each expire ttl seconds after being loaded.
+    The least recently used entry is evicted when the cache is full.
+
+    Writes call invalidate with the keys they change. Every invalidation bumps a generation number,
+    and a value loaded while an invalidation happened is returned but not kept, so a read racing a
+    write can never leave a stale value behind.
+    """
+
+    def __init__(self, max_entries=10000, ttl=30.0, clock=time.monotonic):
+        '''
+            Parameters:
+                    max_entries (int): Most values kept, 0 disables the cache
+                    ttl (float): Seconds a value is served for, None to keep values until evicted or invalidated
+                    clock (callable): Returns the current time in seconds
+        '''
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = collections.OrderedDict()  # key -> (expiry time, value)
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, load):
+        """
+        Returns the cached value for key, calling load(key) to get it if it is missing or expired
+        """
+        if self.max_entries <= 0:
+            return load(key)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (entry[0] is None or entry[0] > self.clock()):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self.generation
+
+        value = load(key)
+
+        with self.lock:
+            # Only keep the value if nothing was invalidated while it was being loaded
+            if generation == self.generation:
+                self.entries[key] = (None if self.ttl is None else self.clock() + self.ttl, value)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+                    self.evictions += 1
+        return value
+
+    def invalidate(self, *keys):
+        """
+        Drops the values of keys, keys that are not cached are ignored
+        """
+        with self.lock:
+            self.generation += 1
+            for key in keys:
+                if self.entries.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def update(self, function):
+        """
+        Calls function(key, value) for every cached value, which may change the value in place.
+        Values for which it returns False are dropped.
+        """
+        with self.lock:
+            self.generation += 1
+            for key in [key for key, (expiry, value) in self.entries.items() if function(key, value) is False]:
+                del self.entries[key]
+                self.invalidations += 1
+
+    def clear(self):
+        """
+        Drops every value
+        """
+        with self.lock:
+            self.generation += 1
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+
+    def stats(self):
+        """
+        Returns the hit, miss, eviction and invalidation counters and the current size
+        """
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
@@ -0,0 +1,205 @@
+import bisect
+import itertools
+import random
+
+import dates
+from hashtags import parse_hashtags
+
+# Seconds in a day
+DAY = 86400
+
+# When generated dates end unless told otherwise, 2024-01-01 00:00 UTC. A fixed epoch rather than
+# today, so the same seed generates the same data on every day and in every timezone
+DEFAULT_END = 1704067200
+
+
+WORDS = (
+    "the a of and to in is it that for on with as was at by this be from or have an they which one "
+    "you were all we when there can more if out so up said what its about into than them only other "
+    "new some could time these two may first then do any like my now over such our man me even most "
+    "made after also did many before must through back years where much your way well down should "
+    "because each just those people how too little state good very make world still own see men work "
+    "long get here between both life being under never day same another know while last might us "
+    "great old year off come since against go came right used take three game team city coffee snow "
+    "winter summer music movie weekend traffic database sqlite python exam project lecture campus"
+).split()
+
+HASHTAGS = (
+    "yeg yyc oilers flames cmput291 sqlite python music movies coffee snow winter summer news sports "
+    "travel food tech jobs weekend health science books art gaming photography fitness"
+).split()
+
+FIRST_NAMES = (
+    "Alex Sam Jordan Taylor Morgan Casey Riley Jamie Avery Quinn Parker Rowan Drew Skyler Reese "
+    "Emerson Hayden Logan Kai Noor Priya Wei Mateo Sofia Amara Yusuf Leila Tomas Ingrid Kenji"
+).split()
+
+LAST_NAMES = (
+    "Smith Lee Wong Patel Brown Singh Martin Tremblay Roy Gagnon Wilson Taylor Nguyen Chen Kim "
+    "Garcia Lopez Muller Rossi Silva Kowalski Ivanova Okafor Haddad Sato Berg Novak Dubois"
+).split()
+
+CITIES = (
+    "Edmonton Calgary Toronto Vancouver Montreal Winnipeg Regina Saskatoon Halifax Victoria "
+    "Ottawa Quebec Kelowna Red Deer Lethbridge Fort McMurray Grande Prairie Banff Jasper Canmore"
+).split()
+
+
+class PowerLaw:
+    """
+    Draws ranks 0..n-1 with probability proportional to 1 / (rank + 1) ** exponent, so a few
+    ranks are drawn very often and most are drawn rarely
+    """
+
+    def __init__(self, n, exponent=1.1):
+        self.cumulative = list(itertools.accumulate(
+            1 / (rank + 1) ** exponent for rank in range(n)))
+
+    def draw(self, rng):
+        """
+        Returns a rank drawn with the random.Random rng
+        """
+        return bisect.bisect_left(self.cumulative, rng.random() * self.cumulative[-1])
+
+
+def generate(store, tweets=10000, users=None, follows_per_user=20, retweet_ratio=0.3,
+             reply_ratio=0.2, hashtag_ratio=0.4, days=365, end=DEFAULT_END, seed=0, chunk_size=10000,
+             progress=None):
+    """
+    Fills a database with realistic synthetic users, follows, tweets, replies, retweets, hashtags and
+    mentions. The same arguments and seed always generate the same data. Rows are streamed to the
+    database in chunks, so memory use does not grow with the size of the data.
+
+    Follows, tweet writers and retweeting users follow power laws: a few users have most of the
+    followers and write most of the tweets.
+
+        Parameters:
+                store (TweeterStore): Store of the database being filled, normally an empty one
+                tweets (int): How many tweets to generate
+                users (int): How many users to generate, tweets / 20 if None
+                follows_per_user (int): Average # of users each user follows
+                retweet_ratio (float): Retweets generated per tweet
+                reply_ratio (float): Share of tweets that reply to an earlier tweet
+                hashtag_ratio (float): Share of tweets with at least one hashtag
+                days (int): How many days the tweets are spread over, ending at end
+                end (int, date, datetime or str): When the generated dates end, see dates.to_epoch
+                seed (int): Seed of the random number generator
+                chunk_size (int): How many rows are written per transaction
+                progress (callable): Called with a message after each table is generated
+
+        Returns: dict of how many rows were generated per table
+    """
+    rng = random.Random(seed)
+    users = users or max(10, tweets // 20)
+    last_day = dates.to_epoch(end)
+    first_day = last_day - days * DAY
+    popularity = PowerLaw(users)
+    vocabulary = PowerLaw(len(WORDS), exponent=1.0)
+    hashtag_popularity = PowerLaw(len(HASHTAGS), exponent=1.0)
+    counts = {}
+
+    def write(sql, rows):
+        count = 0
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                return count
+            store.c.executemany(sql, chunk)
+            store.conn.commit()
+            count += len(chunk)
+
+    # Ids are reserved up front so generated rows never collide with existing ones
+    user_ids = store.ids.next_ids('users', users)
+    tweet_ids = store.ids.next_ids('tweets', tweets)
+    store.conn.commit()
+    # Popularity rank -> user id, shuffled so popular users are spread over the id range
+    ranked_users = list(user_ids)
+    rng.shuffle(ranked_users)
+
+    def user_rows():
+        for usr in user_ids:
+            name = f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+            yield (usr, 'password', name, f"{name.replace(' ', '.').lower()}{usr}@example.com",
+                   rng.choice(CITIES), float(rng.randint(-8, -3)))
+
+    counts['users'] = write(
+        """INSERT INTO users (usr, pwd, name, email, city, timezone) VALUES (?, ?, ?, ?, ?, ?);""",
+        user_rows())
+    if callable(progress):
+        progress(f"{counts['users']} users")
+
+    def follow_rows():
+        for usr in user_ids:
+            followees = set()
+            for _ in range(min(users - 1, int(rng.expovariate(1 / follows_per_user)))):
+                followee = ranked_users[popularity.draw(rng)]
+                if followee != usr:
+                    followees.add(followee)
+            for followee in sorted(followees):
+                yield (usr, followee, first_day + rng.randrange(days * DAY))
+
+    counts['follows'] = write(
+        """INSERT OR IGNORE INTO follows (flwer, flwee, start_date) VALUES (?, ?, ?);""",
+        follow_rows())
+    if callable(progress):
+        progress(f"{counts['follows']} follows")
+
+    def tweet_date(tid):
+        # Tweets are spread evenly over the days in tid order
+        return first_day + (tid - tweet_ids.start) * days * DAY // tweets
+
+    def tweet_rows():
+        for tid in tweet_ids:
+            words = [WORDS[vocabulary.draw(rng)] for _ in range(rng.randint(3, 15))]
+            if rng.random() < hashtag_ratio:
+                for _ in range(rng.randint(1, 3)):
+                    words.insert(rng.randrange(len(words) + 1),
+                                 '#' + HASHTAGS[hashtag_popularity.draw(rng)])
+            replyto = None
+            if tid > tweet_ids.start and rng.random() < reply_ratio:
+                # Replies mostly go to recent tweets
+                replyto = max(tweet_ids.start, tid - 1 - int(rng.expovariate(1 / 50)))
+            yield (tid, ranked_users[popularity.draw(rng)], tweet_date(tid),
+                   ' '.join(words), replyto)
+
+    def mention_rows(rows):
+        for tid, writer, tdate, text, replyto in rows:
+            for term in parse_hashtags(text):
+                yield (tid, term)
+
+    store.c.executemany("""INSERT OR IGNORE INTO hashtags VALUES (?);""",
+                        [(term,) for term in HASHTAGS])
+    counts['tweets'] = counts['mentions'] = 0
+    rows = tweet_rows()
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+        counts['tweets'] += write(
+            """INSERT INTO tweets (tid, writer, tdate, text, replyto) VALUES (?, ?, ?, ?, ?);""", chunk)
+        counts['mentions'] += write(
+            """INSERT OR IGNORE INTO mentions VALUES (?, ?);""", mention_rows(chunk))
+    if callable(progress):
+        progress(f"{counts['tweets']} tweets, {counts['mentions']} mentions")
+
+    def retweet_rows():
+        for _ in range(int(tweets * retweet_ratio)):
+            tid = tweet_ids.start + rng.randrange(tweets)
+            # Retweets mostly come within a few days of the tweet
+            rdate = min(last_day, tweet_date(tid) + int(rng.expovariate(1 / (2 * DAY))))
+            yield (ranked_users[popularity.draw(rng)], tid, rdate)
+
+    counts['retweets'] = write(
+        """INSERT OR IGNORE INTO retweets (usr, tid, rdate) VALUES (?, ?, ?);""", retweet_rows())
+    if callable(progress):
+        progress(f"{counts['retweets']} retweets")
+
+    # Rebuild whichever derived tables this database uses, the full-text indexes are kept by triggers
+    store.clear_caches()
+    if store.stats:
+        store.verify_stats(repair=True)
+    if store.fanout:
+        store.rebuild_timeline()
+
+    return counts
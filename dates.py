@@ -0,0 +1,61 @@
+import datetime
+import numbers
+import time
+
+
+# Names of the row fields holding a date, stored as whole seconds since the Unix epoch
+DATE_FIELDS = ('tdate', 'rdate', 'start_date', 'date')
+
+
+def now():
+    """
+    Returns the current time in seconds since the Unix epoch
+    """
+    return int(time.time())
+
+
+def to_epoch(value):
+    """
+    Returns a date in the form it is stored in, whole seconds since the Unix epoch
+
+    Parameters:
+            value (number, date, datetime or str): An epoch time, a date (taken as local midnight), a datetime
+                                                   (taken as local time when it has no timezone), or either of those
+                                                   as a string. Local time matches format_date, so a date shows as itself
+
+    Raises: ValueError if value is none of those
+    """
+    # bool is an int but never a date
+    if isinstance(value, numbers.Real) and not isinstance(value, bool):
+        # Fractions of a second are dropped, e.g. from a JSON number such as 1700000000.0
+        try:
+            return int(value)
+        except OverflowError:
+            raise ValueError(f"Unsupported date {value!r}") from None
+    if isinstance(value, str):
+        if value.strip().isdigit():
+            return int(value)
+        value = datetime.datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+    if isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+        value = datetime.datetime(value.year, value.month, value.day)
+    if not isinstance(value, datetime.datetime):
+        raise ValueError(f"Unsupported date {value!r}, expected epoch seconds, a date, a datetime or an ISO string")
+    # timestamp() takes a datetime without a timezone as local time
+    return int(value.timestamp())
+
+
+def format_date(epoch):
+    """
+    Returns a stored date as local time for display, e.g. 2024-03-01 14:05
+    """
+    if epoch is None:
+        return ''
+    return datetime.datetime.fromtimestamp(epoch).strftime('%Y-%m-%d %H:%M')
+
+
+def format_row(row):
+    """
+    Returns the values of a store row with its date fields formatted for display
+    """
+    return [format_date(value) if field in DATE_FIELDS else value
+            for field, value in zip(row._fields, row)]
@@ -0,0 +1,169 @@
+import contextlib
+import pathlib
+import queue
+import sqlite3
+import sys
+import threading
+
+
+# Pragmas applied to every connection unless the config overrides them
+DEFAULT_CONFIG = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -64000,  # Negative sizes are in KiB
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'memory',
+    'busy_timeout': 5000,  # Milliseconds
+    'readers': 4,  # Most read-only connections kept in the pool
+    'cache_entries': 10000,  # Most profile cards, and separately tweet statistics, kept in memory
+    'search_cache_entries': 16,  # Most tweet searches whose matching tids are kept in memory
+    'cache_ttl': 30,  # Seconds a cached value is served for, bounds staleness from other processes' writes
+}
+
+# Pragmas that only the writer connection sets
+WRITER_PRAGMAS = ('journal_mode', 'synchronous')
+# Pragmas that every connection sets
+CONNECTION_PRAGMAS = ('cache_size', 'mmap_size', 'temp_store', 'busy_timeout')
+
+
+class Database:
+    """
+    Connections to one sqlite3 database: a single writer connection and a pool of read-only
+    connections. In WAL mode readers do not block behind the writer, so many sessions can read
+    while posts are being written.
+    """
+
+    def __init__(self, target, config=None):
+        '''
+        Opens the writer connection, creating the database if it does not already exist, and sets its pragmas.
+        Reader connections are opened the first time they are needed.
+
+            Parameters:
+                    target (str): Filename of the database
+                    config (dict): Overrides for DEFAULT_CONFIG
+
+        '''
+        self.config = dict(DEFAULT_CONFIG, **(config or {}))
+        self.target = target
+        # In-memory databases cannot be shared between connections, reads go through the writer
+        self.shared = target not in ('', ':memory:') and not target.startswith('file::memory:')
+
+        self.writer = sqlite3.connect(target, check_same_thread=False)
+        self.write_lock = threading.RLock()
+        self.configure(self.writer, WRITER_PRAGMAS + CONNECTION_PRAGMAS)
+
+        self.readers = queue.LifoQueue()
+        self.reader_count = 0
+        self.reader_lock = threading.Lock()
+        self.trace_callback = None
+        self.progress_handler = None
+        # metrics.QueryMetrics timing every fetch, None when metrics are disabled
+        self.metrics = None
+
+    def configure(self, conn, pragmas):
+        """
+        Sets the given pragmas on a connection from the config
+
+        Parameters:
+                conn (Connection): Connection being configured
+                pragmas (tuple(str)): Names of the pragmas to set
+        """
+        for pragma in pragmas:
+            value = self.config.get(pragma)
+            if value is not None:
+                # PRAGMA does not take parameters, the values come from the config not the user
+                conn.execute(f"PRAGMA {pragma} = {value};").fetchall()
+
+    def open_reader(self):
+        """
+        Opens a read-only connection to the database
+        """
+        uri = pathlib.Path(self.target).absolute().as_uri() + '?mode=ro'
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        self.configure(conn, CONNECTION_PRAGMAS)
+        conn.set_trace_callback(self.trace_callback)
+        if self.progress_handler is not None:
+            conn.set_progress_handler(*self.progress_handler)
+        return conn
+
+    @contextlib.contextmanager
+    def reader(self):
+        """
+        Lends out a read-only connection from the pool, opening a new one if the pool is not full yet
+        and waiting for one to be returned otherwise
+        """
+        if not self.shared:
+            with self.write_lock:
+                yield self.writer
+            return
+
+        try:
+            conn = self.readers.get_nowait()
+        except queue.Empty:
+            with self.reader_lock:
+                opened = self.reader_count < self.config['readers']
+                if opened:
+                    self.reader_count += 1
+            conn = self.open_reader() if opened else self.readers.get()
+
+        try:
+            yield conn
+        finally:
+            # End the read transaction so the next query sees the latest commits
+            conn.rollback()
+            self.readers.put(conn)
+
+    def fetchall(self, sql, params=(), row_type=None):
+        """
+        Runs a query on a pooled reader and returns every row, as row_type if one is given
+        """
+        with self.reader() as conn:
+            if self.metrics is None:
+                rows = conn.execute(sql, params).fetchall()
+            else:
+                rows = self.metrics.run(sys._getframe(1).f_code.co_name, conn, sql, params,
+                                        lambda: conn.execute(sql, params).fetchall(), len)
+
+        if row_type is not None:
+            return [row_type._make(row) for row in rows]
+        return rows
+
+    def fetchone(self, sql, params=()):
+        """
+        Runs a query on a pooled reader and returns the first row, None if there are no rows
+        """
+        with self.reader() as conn:
+            if self.metrics is None:
+                return conn.execute(sql, params).fetchone()
+            return self.metrics.run(sys._getframe(1).f_code.co_name, conn, sql, params,
+                                    lambda: conn.execute(sql, params).fetchone(), lambda row: int(row is not None))
+
+    def set_trace_callback(self, callback):
+        """
+        Sets the trace callback of the writer and of every reader, including readers opened later
+        """
+        self.trace_callback = callback
+        self.writer.set_trace_callback(callback)
+        for conn in list(self.readers.queue):
+            conn.set_trace_callback(callback)
+
+    def set_progress_handler(self, handler, n):
+        """
+        Sets the progress handler of the writer and of every reader, including readers opened later
+        """
+        self.progress_handler = (handler, n)
+        self.writer.set_progress_handler(handler, n)
+        for conn in list(self.readers.queue):
+            conn.set_progress_handler(handler, n)
+
+    def close(self):
+        """
+        Commits any pending writes and closes every connection
+        """
+        while True:
+            try:
+                self.readers.get_nowait().close()
+            except queue.Empty:
+                break
+        self.writer.commit()
+        self.writer.close()
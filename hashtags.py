@@ -0,0 +1,27 @@
+import unicodedata
+
+
+def normalize_hashtag(term):
+    """
+    Returns the form a hashtag term is stored and searched in: Unicode NFKC normalized, case folded
+    and without leading or trailing punctuation, so #Tag, #tag, and #ｔａｇ are all the term tag.
+    Returns an empty string for a term that is only punctuation.
+
+    Parameters:
+            term (str): Hashtag term without its leading #
+    """
+    term = unicodedata.normalize('NFKC', unicodedata.normalize('NFKC', term).casefold())
+    start, end = 0, len(term)
+    while start < end and unicodedata.category(term[start]).startswith('P'):
+        start += 1
+    while end > start and unicodedata.category(term[end - 1]).startswith('P'):
+        end -= 1
+    return term[start:end]
+
+
+def parse_hashtags(text):
+    """
+    Returns the normalized hashtag terms in a tweets text, each term once in the order it first appears
+    """
+    terms = (normalize_hashtag(word[1:]) for word in text.split() if word.startswith('#'))
+    return list(dict.fromkeys(term for term in terms if term))
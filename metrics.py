@@ -0,0 +1,246 @@
+import json
+import logging
+import sys
+import threading
+import time
+
+
+# Upper bounds in seconds of the latency histogram buckets, the last bucket takes everything slower
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+logger = logging.getLogger('tweeter.queries')
+
+
+class Histogram:
+    """
+    Latency histogram of the queries run by one store method, with the rows they returned
+    """
+    __slots__ = ('buckets', 'counts', 'count', 'total', 'rows', 'slowest', 'vm_steps')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.rows = 0
+        self.slowest = 0.0
+        # Progress handler calls made while this method's queries ran, a measure of the work sqlite did
+        self.vm_steps = 0
+
+    def observe(self, elapsed, rows):
+        """
+        Records one query that took elapsed seconds and returned or changed rows rows
+        """
+        index = 0
+        while index < len(self.buckets) and elapsed > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += elapsed
+        self.rows += rows
+        self.slowest = max(self.slowest, elapsed)
+
+    def snapshot(self):
+        """
+        Returns the histogram as a JSON serializable dict, bucket counts are cumulative
+        """
+        cumulative = []
+        running = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            running += count
+            cumulative.append(['+Inf' if bound == float('inf') else bound, running])
+        return {
+            'count': self.count,
+            'sum_seconds': self.total,
+            'slowest_seconds': self.slowest,
+            'rows': self.rows,
+            'vm_steps': self.vm_steps,
+            'buckets': cumulative,
+        }
+
+
+class QueryMetrics:
+    """
+    Collects the latency and row count of every query a TweeterStore runs, keyed by the store method
+    that ran it. Queries slower than slow_threshold are logged with their parameters and query plan.
+
+    The store only calls into this class when metrics are enabled, a store without metrics pays
+    one attribute check per query.
+    """
+
+    def __init__(self, slow_threshold=0.1, buckets=DEFAULT_BUCKETS, explain_slow=True, trace=False,
+                 progress_steps=None):
+        '''
+            Parameters:
+                    slow_threshold (float): Seconds after which a query is logged as slow, None to never log
+                    buckets (tuple(float)): Upper bounds in seconds of the histogram buckets
+                    explain_slow (bool): Log the EXPLAIN QUERY PLAN of slow queries
+                    trace (bool): Log every statement sqlite runs, including trigger bodies, at DEBUG level
+                    progress_steps (int): Count sqlite virtual machine steps in batches of this many, None to not count
+        '''
+        self.slow_threshold = slow_threshold
+        self.buckets = tuple(buckets)
+        self.explain_slow = explain_slow
+        self.trace = trace
+        self.progress_steps = progress_steps
+        self.histograms = {}
+        self.slow_queries = 0
+        self.lock = threading.Lock()
+        # Store method running on each thread, so the progress handler knows who to charge
+        self.current = threading.local()
+
+    def install(self, db):
+        """
+        Sets the trace callback and progress handler asked for on every connection of a Database
+        """
+        if self.trace:
+            db.set_trace_callback(lambda statement: logger.debug("%s", statement))
+        if self.progress_steps:
+            db.set_progress_handler(self.on_progress, self.progress_steps)
+
+    def on_progress(self):
+        """
+        Progress handler, charges one batch of virtual machine steps to the running method
+        """
+        histogram = self.histograms.get(getattr(self.current, 'method', None))
+        if histogram is not None:
+            histogram.vm_steps += 1
+        # Returning a true value would abort the query
+        return 0
+
+    def histogram(self, method):
+        """
+        Returns the histogram of a store method, creating it the first time the method is seen
+        """
+        histogram = self.histograms.get(method)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(method, Histogram(self.buckets))
+        return histogram
+
+    def run(self, method, conn, sql, params, execute, count):
+        """
+        Runs one query, timing it under method
+
+            Parameters:
+                    method (str): Name of the store method running the query
+                    conn (Connection): Connection the query runs on, used to explain it if it is slow
+                    sql (str): SQL of the query
+                    params (tuple): Parameters of the query
+                    execute (callable): Runs the query and returns its result
+                    count (callable): Returns how many rows a result returned or changed
+
+            Returns: the result of execute
+        """
+        histogram = self.histogram(method)
+        self.current.method = method
+        start = time.perf_counter()
+        try:
+            result = execute()
+        finally:
+            elapsed = time.perf_counter() - start
+            self.current.method = None
+        with self.lock:
+            histogram.observe(elapsed, count(result))
+
+        if self.slow_threshold is not None and elapsed >= self.slow_threshold:
+            self.log_slow(method, conn, sql, params, elapsed)
+        return result
+
+    def log_slow(self, method, conn, sql, params, elapsed):
+        """
+        Logs a slow query with its parameters and, for queries that can be explained, its plan
+        """
+        with self.lock:
+            self.slow_queries += 1
+        plan = ''
+        if self.explain_slow and sql.lstrip().upper().startswith(('SELECT', 'WITH')):
+            try:
+                plan = '\n'.join(row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params))
+            except Exception as error:
+                plan = f"(could not explain: {error})"
+        logger.warning("Slow query in %s took %.1f ms\n%s\nparams: %r\n%s",
+                       method, elapsed * 1000, sql.strip(), params, plan)
+
+    def cursor(self, cursor):
+        """
+        Returns a wrapper of a writer cursor that times its statements
+        """
+        return InstrumentedCursor(cursor, self)
+
+    def snapshot(self):
+        """
+        Returns every histogram as a JSON serializable dict keyed by store method
+        """
+        with self.lock:
+            return {
+                'slow_queries': self.slow_queries,
+                'methods': {method: histogram.snapshot()
+                            for method, histogram in sorted(self.histograms.items())},
+            }
+
+    def to_json(self):
+        """
+        Returns the snapshot as a JSON document
+        """
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self):
+        """
+        Returns the snapshot in the Prometheus text exposition format
+        """
+        snapshot = self.snapshot()
+        lines = [
+            "# HELP tweeter_query_seconds Latency of the queries run by each store method",
+            "# TYPE tweeter_query_seconds histogram",
+        ]
+        for method, histogram in snapshot['methods'].items():
+            for bound, count in histogram['buckets']:
+                lines.append(f'tweeter_query_seconds_bucket{{method="{method}",le="{bound}"}} {count}')
+            lines.append(f'tweeter_query_seconds_sum{{method="{method}"}} {histogram["sum_seconds"]}')
+            lines.append(f'tweeter_query_seconds_count{{method="{method}"}} {histogram["count"]}')
+        lines.append("# HELP tweeter_query_rows_total Rows returned or changed by each store method's queries")
+        lines.append("# TYPE tweeter_query_rows_total counter")
+        for method, histogram in snapshot['methods'].items():
+            lines.append(f'tweeter_query_rows_total{{method="{method}"}} {histogram["rows"]}')
+        lines.append("# HELP tweeter_slow_queries_total Queries slower than the slow query threshold")
+        lines.append("# TYPE tweeter_slow_queries_total counter")
+        lines.append(f"tweeter_slow_queries_total {snapshot['slow_queries']}")
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """
+        Saves the snapshot to path, in the Prometheus text format if it ends in .prom and as JSON otherwise
+        """
+        with open(path, 'w') as file:
+            file.write(self.to_prometheus() if path.endswith('.prom') else self.to_json())
+
+
+class InstrumentedCursor:
+    """
+    Wraps a sqlite3 Cursor, timing execute and executemany under the store method that called them.
+    Everything else is passed through to the wrapped cursor.
+    """
+
+    def __init__(self, cursor, metrics):
+        self.cursor = cursor
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    @staticmethod
+    def rowcount(cursor):
+        # rowcount is -1 for statements that are not DML
+        return max(cursor.rowcount, 0)
+
+    def execute(self, sql, params=()):
+        return self.metrics.run(sys._getframe(1).f_code.co_name, self.cursor.connection, sql, params,
+                                lambda: self.cursor.execute(sql, params), self.rowcount)
+
+    def executemany(self, sql, seq_of_params):
+        return self.metrics.run(sys._getframe(1).f_code.co_name, self.cursor.connection, sql, (),
+                                lambda: self.cursor.executemany(sql, seq_of_params), self.rowcount)
@@ -0,0 +1,160 @@
+import concurrent.futures
+import time
+
+
+def completed(result):
+    """
+    Returns a Future that already holds result
+    """
+    future = concurrent.futures.Future()
+    future.set_result(result)
+    return future
+
+
+def offset_pages(query, page_size):
+    """
+    Adapts a query taking a page number to the fetch function Pager expects
+
+        Parameters:
+                query (callable): Called with a page number, returns at most page_size rows
+                page_size (int): Rows per page
+
+        Returns: fetch function returning (rows, next page number or None on the last page)
+    """
+    def fetch(page):
+        rows = query(page)
+        return rows, page + 1 if len(rows) == page_size else None
+
+    return fetch
+
+
+class Pager:
+    """
+    Pages through the results of fetch(key), which returns (rows, key of the next page or None).
+
+    With an executor the next page is fetched in the background while the current page is shown,
+    and the previous page is kept so going back is instant. Store queries run on pooled read-only
+    connections, so a background fetch never shares a connection with the screen's own queries.
+    Prefetched pages older than max_age seconds are fetched again rather than shown.
+    """
+
+    def __init__(self, fetch, first_key=None, executor=None, max_age=30.0):
+        '''
+        Fetches the first page
+
+            Parameters:
+                    fetch (callable): Called with a page key, returns (rows, next key or None)
+                    first_key: Key of the first page
+                    executor (Executor): Runs background fetches, None to only fetch pages when they are shown
+                    max_age (float): Seconds a prefetched page may be shown for after it was fetched
+        '''
+        self.fetch = fetch
+        self.executor = executor
+        self.max_age = max_age
+        # Keys of the pages visited so far, the last one is the current page
+        self.keys = [first_key]
+        self.rows, self.next_key = fetch(first_key)
+        # (submit time, Future) of the next and previous pages
+        self.next_page = None
+        self.previous_page = None
+        self.prefetch()
+
+    @property
+    def page(self):
+        """
+        Number of the current page, counting from 0
+        """
+        return len(self.keys) - 1
+
+    def submit(self, key):
+        """
+        Starts fetching a page in the background, returns None without an executor
+        """
+        if self.executor is None:
+            return None
+        return (time.monotonic(), self.executor.submit(self.fetch, key))
+
+    def prefetch(self):
+        """
+        Starts fetching the page after the current one
+        """
+        self.discard(self.next_page)
+        self.next_page = self.submit(self.next_key) if self.next_key is not None else None
+
+    def take(self, pending, key):
+        """
+        Returns a page from a background fetch if it is still fresh, fetching it now otherwise
+        """
+        if pending is not None:
+            submitted, future = pending
+            if time.monotonic() - submitted <= self.max_age:
+                return future.result()
+            future.cancel()
+        return self.fetch(key)
+
+    @staticmethod
+    def discard(pending):
+        """
+        Cancels a background fetch, a fetch that has already started finishes and is ignored
+        """
+        if pending is not None:
+            pending[1].cancel()
+
+    def next(self):
+        """
+        Moves to the next page
+
+        Returns: False if there is no next page, the current page is unchanged
+        """
+        if self.next_key is None:
+            return False
+
+        rows, next_key = self.take(self.next_page, self.next_key)
+        self.next_page = None
+        # The last page can be full, in which case the page after it is empty
+        if not rows:
+            self.next_key = None
+            return False
+
+        self.discard(self.previous_page)
+        self.previous_page = (time.monotonic(), completed((self.rows, self.next_key)))
+        self.keys.append(self.next_key)
+        self.rows, self.next_key = rows, next_key
+        self.prefetch()
+        return True
+
+    def prev(self):
+        """
+        Moves to the previous page
+
+        Returns: False if this is the first page
+        """
+        if len(self.keys) == 1:
+            return False
+
+        current = (self.rows, self.next_key)
+        self.keys.pop()
+        self.rows, self.next_key = self.take(self.previous_page, self.keys[-1])
+
+        # The page just left becomes the next page, and the page before this one is fetched in the background
+        self.discard(self.next_page)
+        self.next_page = (time.monotonic(), completed(current))
+        self.previous_page = self.submit(self.keys[-2]) if len(self.keys) > 1 else None
+        return True
+
+    def refresh(self):
+        """
+        Fetches the current page again and drops prefetched pages, after the user may have changed the results
+        """
+        self.rows, self.next_key = self.fetch(self.keys[-1])
+        self.discard(self.previous_page)
+        self.previous_page = self.submit(self.keys[-2]) if len(self.keys) > 1 else None
+        self.prefetch()
+
+    def close(self):
+        """
+        Cancels background fetches when leaving the screen
+        """
+        self.discard(self.next_page)
+        self.discard(self.previous_page)
+        self.next_page = self.previous_page = None
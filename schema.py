@@ -0,0 +1,316 @@
+import re
+import sqlite3
+
+from hashtags import normalize_hashtag
+
+
+def normalize_hashtags(conn):
+    """
+    Rewrites every hashtag and mention term in the form normalize_hashtag gives, so hashtag searches
+    can seek the term index for an exact match. Mentions that become duplicates, and terms that were
+    only punctuation, are dropped.
+    """
+    conn.create_function('normalize_hashtag', 1, normalize_hashtag, deterministic=True)
+    for statement in split_statements("""
+        INSERT OR IGNORE INTO hashtags (term)
+        SELECT normalize_hashtag(term) FROM hashtags WHERE normalize_hashtag(term) != '';
+        UPDATE OR IGNORE mentions SET term = normalize_hashtag(term) WHERE term != normalize_hashtag(term);
+        DELETE FROM mentions WHERE term != normalize_hashtag(term) OR term = '';
+        DELETE FROM hashtags WHERE term != normalize_hashtag(term) OR term = '';
+        DROP INDEX IF EXISTS mentions_term;
+        CREATE INDEX IF NOT EXISTS mentions_term_tid ON mentions (term, tid);
+    """):
+        conn.execute(statement)
+
+
+# Columns that identify a row of each table whose writes rely on ON CONFLICT DO NOTHING
+UNIQUE_KEYS = {
+    'follows': ('flwer', 'flwee'),
+    'retweets': ('usr', 'tid'),
+    'hashtags': ('term',),
+    'mentions': ('tid', 'term'),
+}
+
+
+def has_unique_key(conn, table, columns):
+    """
+    Checks if a primary key or unique index of table covers exactly the given columns
+    """
+    for index in conn.execute(f"PRAGMA index_list({table});").fetchall():
+        name, unique = index[1], index[2]
+        if unique and tuple(row[2] for row in conn.execute(f"PRAGMA index_info({name});")) == columns:
+            return True
+    return False
+
+
+def enforce_unique_keys(conn):
+    """
+    Makes sure every table in UNIQUE_KEYS has a unique key, so ON CONFLICT DO NOTHING skips repeated
+    follows, retweets and mentions. Tables created from the base schema already have them as primary
+    keys. Tables that predate it are deduplicated, keeping the first copy of each row, then given a
+    unique index. Delete triggers keep the statistics counters right while duplicates are removed.
+    """
+    for table, columns in UNIQUE_KEYS.items():
+        if has_unique_key(conn, table, columns):
+            continue
+        key = ', '.join(columns)
+        conn.execute(f"""
+            DELETE FROM {table} WHERE rowid NOT IN (SELECT MIN(rowid) FROM {table} GROUP BY {key});
+        """)
+        conn.execute(f"""CREATE UNIQUE INDEX IF NOT EXISTS {table}_unique ON {table} ({key});""")
+
+
+def epoch_dates(conn):
+    """
+    Converts the ISO text dates of tweets, retweets, follows and the timeline to whole seconds since
+    the Unix epoch, which take less space and compare as integers. The dates were written by
+    date.today(), so like dates.to_epoch they are taken as local time: a date without a time is local
+    midnight. Text that is not a date is left as it is.
+    """
+    columns = [('tweets', 'tdate'), ('retweets', 'rdate'), ('follows', 'start_date')]
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'timeline';").fetchone():
+        columns.append(('timeline', 'date'))
+
+    for table, column in columns:
+        conn.execute(f"""
+            UPDATE OR IGNORE {table} SET {column} = CAST(strftime('%s', {column}, 'utc') AS INTEGER)
+            WHERE typeof({column}) = 'text' AND strftime('%s', {column}, 'utc') IS NOT NULL;
+        """)
+    # Timeline entries whose converted key was already there are duplicates
+    if len(columns) == 4:
+        conn.execute("DELETE FROM timeline WHERE typeof(date) = 'text' AND strftime('%s', date) IS NOT NULL;")
+
+
+# Each migration upgrades the database by one version, the version is kept in PRAGMA user_version.
+# Migrations are SQL scripts, or functions called with the connection for changes SQL cannot make alone.
+# Migrations are only ever appended, never edited once they have shipped.
+MIGRATIONS = [
+    # 1: Base tables
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        usr int,
+        pwd text,
+        name text,
+        email text,
+        city text,
+        timezone float,
+        PRIMARY KEY (usr)
+    );
+    CREATE TABLE IF NOT EXISTS follows (
+        flwer int,
+        flwee int,
+        start_date date,
+        PRIMARY KEY (flwer, flwee),
+        FOREIGN KEY (flwer) REFERENCES users,
+        FOREIGN KEY (flwee) REFERENCES users
+    );
+    CREATE TABLE IF NOT EXISTS tweets (
+        tid int,
+        writer int,
+        tdate date,
+        text text,
+        replyto int,
+        PRIMARY KEY (tid),
+        FOREIGN KEY (writer) REFERENCES users,
+        FOREIGN KEY (replyto) REFERENCES tweets
+    );
+    CREATE TABLE IF NOT EXISTS hashtags (
+        term text,
+        PRIMARY KEY (term)
+    );
+    CREATE TABLE IF NOT EXISTS mentions (
+        tid int,
+        term text,
+        PRIMARY KEY (tid, term),
+        FOREIGN KEY (tid) REFERENCES tweets,
+        FOREIGN KEY (term) REFERENCES hashtags
+    );
+    CREATE TABLE IF NOT EXISTS retweets (
+        usr int,
+        tid int,
+        rdate date,
+        PRIMARY KEY (usr, tid),
+        FOREIGN KEY (usr) REFERENCES users,
+        FOREIGN KEY (tid) REFERENCES tweets
+    );
+    CREATE TABLE IF NOT EXISTS lists (
+        lname text,
+        owner int,
+        PRIMARY KEY (lname),
+        FOREIGN KEY (owner) REFERENCES users
+    );
+    CREATE TABLE IF NOT EXISTS includes (
+        lname text,
+        member int,
+        PRIMARY KEY (lname, member),
+        FOREIGN KEY (lname) REFERENCES lists,
+        FOREIGN KEY (member) REFERENCES users
+    );
+    """,
+    # 2: Id sequences used by IdAllocator
+    """
+    CREATE TABLE IF NOT EXISTS id_sequences (
+        name text PRIMARY KEY,
+        next_id int NOT NULL
+    );
+    """,
+    # 3: Indexes for the queries in Tweeter. follows(flwer) is served by the primary key
+    """
+    CREATE INDEX IF NOT EXISTS tweets_writer_tdate ON tweets (writer, tdate);
+    CREATE INDEX IF NOT EXISTS tweets_replyto ON tweets (replyto);
+    CREATE INDEX IF NOT EXISTS follows_flwee ON follows (flwee, flwer, start_date);
+    CREATE INDEX IF NOT EXISTS retweets_tid ON retweets (tid);
+    CREATE INDEX IF NOT EXISTS retweets_usr_rdate ON retweets (usr, rdate);
+    CREATE INDEX IF NOT EXISTS mentions_term ON mentions (term COLLATE NOCASE, tid);
+    """,
+    # 4: Keyset pagination of a users tweets seeks on (tdate, tid), which replaces the (writer, tdate) index
+    """
+    CREATE INDEX IF NOT EXISTS tweets_writer_tdate_tid ON tweets (writer, tdate, tid);
+    DROP INDEX IF EXISTS tweets_writer_tdate;
+    """,
+    # 5: Normalized hashtag terms, searched with an exact match on the (term, tid) index
+    normalize_hashtags,
+    # 6: Unique keys for idempotent follows, retweets and mentions
+    enforce_unique_keys,
+    # 7: Dates stored as integer epoch seconds
+    epoch_dates,
+    # 8: Replies to a tweet in the order threads show them, which replaces the replyto index
+    """
+    CREATE INDEX IF NOT EXISTS tweets_replyto_tdate_tid ON tweets (replyto, tdate, tid);
+    DROP INDEX IF EXISTS tweets_replyto;
+    """,
+    # 9: Hourly hashtag counters for trending, kept by triggers on mentions and filled from the last week of tweets
+    """
+    CREATE TABLE IF NOT EXISTS hashtag_counts (
+        hour int,
+        term text,
+        count int NOT NULL,
+        PRIMARY KEY (hour, term)
+    ) WITHOUT ROWID;
+    CREATE TRIGGER IF NOT EXISTS hashtag_counts_mention_insert AFTER INSERT ON mentions BEGIN
+        INSERT INTO hashtag_counts (hour, term, count)
+        SELECT tdate / 3600, NEW.term, 1 FROM tweets WHERE tid = NEW.tid AND tdate IS NOT NULL
+        ON CONFLICT DO UPDATE SET count = count + 1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS hashtag_counts_mention_delete AFTER DELETE ON mentions BEGIN
+        UPDATE hashtag_counts SET count = count - 1
+        WHERE hour = (SELECT tdate / 3600 FROM tweets WHERE tid = OLD.tid) AND term = OLD.term;
+        DELETE FROM hashtag_counts
+        WHERE hour = (SELECT tdate / 3600 FROM tweets WHERE tid = OLD.tid) AND term = OLD.term AND count <= 0;
+    END;
+    INSERT INTO hashtag_counts (hour, term, count)
+    SELECT tweets.tdate / 3600, mentions.term, COUNT(*)
+    FROM mentions JOIN tweets ON tweets.tid = mentions.tid
+    WHERE tweets.tdate >= CAST(strftime('%s', 'now') AS INTEGER) - 7 * 86400
+    GROUP BY 1, 2;
+    """,
+    # 10: Settings shared by every session on the database, such as the timeline cap
+    """
+    CREATE TABLE IF NOT EXISTS settings (
+        name text PRIMARY KEY,
+        value
+    );
+    """,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+class QueryPlanError(Exception):
+    """
+    Raised by check_query_plans when queries fall back to full table scans
+    """
+
+    def __init__(self, scans):
+        '''
+            Parameters:
+                    scans (list(tuple(str, str))): (query, plan detail) of every full table scan found
+        '''
+        self.scans = scans
+        super().__init__("\n\n".join(
+            f"{detail} in:\n{query}" for query, detail in scans))
+
+
+def get_version(conn):
+    """
+    Returns the schema version of the database
+    """
+    return conn.execute("PRAGMA user_version;").fetchone()[0]
+
+
+def split_statements(script):
+    """
+    Splits an SQL script into its statements, keeping trigger bodies whole
+    """
+    statements = []
+    statement = ''
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            statements.append(statement.strip())
+            statement = ''
+
+    return statements
+
+
+def migrate(conn):
+    """
+    Applies every migration the database has not had yet in a single transaction. The write lock is
+    taken before the version is read, so processes starting together never migrate twice.
+
+        Parameters:
+                conn (Connection): Connection to the database being migrated
+
+        Returns: the schema version of the database after migrating
+    """
+    if get_version(conn) == SCHEMA_VERSION:
+        return SCHEMA_VERSION
+
+    conn.commit()
+    conn.execute("BEGIN IMMEDIATE;")
+    try:
+        version = get_version(conn)
+        if version > SCHEMA_VERSION:
+            raise RuntimeError(
+                f"Database schema version {version} is newer than this program's version {SCHEMA_VERSION}")
+
+        for version, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            if callable(migration):
+                migration(conn)
+            else:
+                for statement in split_statements(migration):
+                    conn.execute(statement)
+            # PRAGMA does not take parameters, version is always an int
+            conn.execute(f"PRAGMA user_version = {version};")
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+    return version
+
+
+def check_query_plans(conn, queries):
+    """
+    Runs EXPLAIN QUERY PLAN on every query and fails if any of them scans a whole table.
+    Searches of the full-text index are not scans.
+
+        Parameters:
+                conn (Connection): Connection to a migrated database
+                queries (iterable(str)): SQL of the queries with their parameters filled in
+
+        Raises: QueryPlanError listing every full table scan found
+    """
+    tables = {name for name, in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table';")}
+
+    scans = []
+    for query in queries:
+        for row in conn.execute(f"EXPLAIN QUERY PLAN {query}"):
+            detail = row[3]
+            match = re.match(r'SCAN (\S+)', detail)
+            if match and match.group(1) in tables and 'VIRTUAL TABLE' not in detail:
+                scans.append((query, detail))
+
+    if scans:
+        raise QueryPlanError(scans)
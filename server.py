@@ -0,0 +1,338 @@
+import asyncio
+import concurrent.futures
+import functools
+import json
+import logging
+import sqlite3
+
+import dates
+from store import TRENDING_RETENTION_HOURS
+
+
+logger = logging.getLogger('tweeter.server')
+
+MAX_PAGE_SIZE = 100
+# Most replies a thread request may load, breadth + breadth ** 2 + ... + breadth ** depth
+MAX_THREAD_TWEETS = 1000
+
+
+class Session:
+    """
+    State of one connected client: the logged in user and where they are in their follow feed
+    """
+    __slots__ = ('user_id', 'feed_cursors', 'next_feed_cursor')
+
+    def __init__(self):
+        self.user_id = None
+        # Stack of cursors for the feed pages visited so far, the top is the current page
+        self.feed_cursors = [None]
+        self.next_feed_cursor = None
+
+
+class RequestError(Exception):
+    """
+    Raised by a request handler when the request cannot be served, the message is sent to the client
+    """
+
+
+class TweeterServer:
+    """
+    Serves many sessions from one TweeterStore over a local TCP socket. Requests and responses are
+    JSON objects, one per line. Each request names an op and may carry an id that is echoed back:
+
+        {"id": 1, "op": "login", "user_id": 3, "password": "pw"}
+        {"id": 1, "ok": true, "result": true}
+
+    Blocking sqlite3 calls run on a bounded thread pool so the event loop never waits on the database.
+    """
+
+    def __init__(self, store, workers=8, writes=None):
+        '''
+            Parameters:
+                    store (TweeterStore): Store every session reads and writes through
+                    workers (int): Most sqlite3 calls running at once
+                    writes (writequeue.WriteQueue): Queue that group commits writes, None to commit each write on the thread pool
+        '''
+        self.store = store
+        self.writes = writes
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='tweeter-db')
+        self.handlers = {
+            'login': self.login,
+            'logout': self.logout,
+            'feed': self.feed,
+            'search_tweets': self.search_tweets,
+            'search_users': self.search_users,
+            'compose': self.compose,
+            'follow': self.follow,
+            'retweet': self.retweet,
+            'thread': self.thread,
+            'trending': self.trending,
+            'replies': self.replies,
+            'metrics': self.metrics,
+        }
+
+    async def run(self, function, *args, **kwargs):
+        """
+        Runs a blocking store call on the thread pool
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(function, *args, **kwargs))
+
+    async def write(self, function, *args, **kwargs):
+        """
+        Runs a store write through the write queue, or on the thread pool while holding the writer lock
+        without one. Every write shares one connection
+        """
+        if self.writes is not None:
+            return await asyncio.wrap_future(self.writes.submit(function, *args, **kwargs))
+
+        def locked():
+            with self.store.db.write_lock:
+                return function(*args, **kwargs)
+
+        return await self.run(locked)
+
+    async def handle_client(self, reader, writer):
+        """
+        Serves one client connection until it disconnects
+        """
+        session = Session()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                response = await self.handle_request(session, line)
+                writer.write(json.dumps(response, default=str).encode() + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def handle_request(self, session, line):
+        """
+        Decodes one request line, runs its handler and returns the response object
+        """
+        request_id = None
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise RequestError("Requests must be JSON objects")
+            request_id = request.get('id')
+            handler = self.handlers.get(request.get('op'))
+            if handler is None:
+                raise RequestError(f"Unknown op {request.get('op')!r}")
+            result = await handler(session, request)
+        except KeyError as error:
+            return {'id': request_id, 'ok': False, 'error': f"Missing field {error}"}
+        except (RequestError, ValueError, TypeError, sqlite3.Error) as error:
+            return {'id': request_id, 'ok': False, 'error': str(error)}
+
+        return {'id': request_id, 'ok': True, 'result': result}
+
+    def require_login(self, session):
+        """
+        Returns the sessions user id, raising RequestError if nobody is logged in
+        """
+        if session.user_id is None:
+            raise RequestError("Login required")
+        return session.user_id
+
+    @staticmethod
+    def page_size(request):
+        """
+        Returns the page size asked for by a request, 5 if none was given
+        """
+        page_size = int(request.get('page_size', 5))
+        if not 0 < page_size <= MAX_PAGE_SIZE:
+            raise RequestError(f"page_size must be between 1 and {MAX_PAGE_SIZE}")
+        return page_size
+
+    async def login(self, session, request):
+        """
+        Logs the session in if user_id and password match a user
+        """
+        user_id = int(request['user_id'])
+        if not await self.run(self.store.check_login, user_id, request.get('password')):
+            raise RequestError("Incorrect User Id or Password")
+
+        session.user_id = user_id
+        session.feed_cursors = [None]
+        session.next_feed_cursor = None
+        return True
+
+    async def logout(self, session, request):
+        """
+        Logs the session out
+        """
+        session.user_id = None
+        return True
+
+    async def feed(self, session, request):
+        """
+        Returns a page of the follow feed. page is 'first', 'next', 'prev' or 'current' (the default)
+        """
+        user_id = self.require_login(session)
+        page_size = self.page_size(request)
+        page = request.get('page', 'current')
+        # The session's cursor stack only changes once the page has been read
+        cursors = session.feed_cursors
+        if page == 'first':
+            cursors = [None]
+        elif page == 'next':
+            if session.next_feed_cursor is None:
+                raise RequestError("No more tweets found")
+            cursors = cursors + [session.next_feed_cursor]
+        elif page == 'prev':
+            if len(cursors) > 1:
+                cursors = cursors[:-1]
+        elif page != 'current':
+            raise RequestError(f"Unknown page {page!r}")
+
+        tweets, next_cursor = await self.run(
+            self.store.get_follow_feed_tweets, user_id, cursor=cursors[-1], page_size=page_size)
+        session.feed_cursors, session.next_feed_cursor = cursors, next_cursor
+        return {'tweets': [tweet._asdict() for tweet in tweets],
+                'has_next': next_cursor is not None}
+
+    async def search_tweets(self, session, request):
+        """
+        Returns a page of the tweets matching keywords, words prefixed with # are hashtags
+        """
+        keywords = str(request['keywords']).split()
+        if not keywords:
+            raise RequestError("No keywords entered")
+        hashtag_keywords = [word[1:] for word in keywords if word.startswith('#')]
+        text_keywords = [word for word in keywords if not word.startswith('#')]
+
+        tweets = await self.run(
+            self.store.search_for_tweets_query, hashtag_keywords, text_keywords,
+            page=int(request.get('page', 0)), page_size=self.page_size(request),
+            order=request.get('order', 'date'))
+        return [tweet._asdict() for tweet in tweets]
+
+    async def search_users(self, session, request):
+        """
+        Returns a page of the users whose name or city contains keyword
+        """
+        page_size = self.page_size(request)
+        users = await self.run(
+            self.store.search_for_user_query, str(request['keyword']).strip(),
+            offset=int(request.get('page', 0)) * page_size, page_size=page_size)
+        return [user._asdict() for user in users]
+
+    async def compose(self, session, request):
+        """
+        Posts a tweet, or a reply if replyto is given, and returns its tid
+        """
+        user_id = self.require_login(session)
+        text = str(request['text'])
+        replyto = request.get('replyto')
+        return await self.write(
+            self.store.insert_tweet, user_id, dates.now(), text,
+            replyto=None if replyto is None else int(replyto))
+
+    async def follow(self, session, request):
+        """
+        Follows user_id, returns False if the session user was already following them
+        """
+        user_id = self.require_login(session)
+        return await self.write(self.store.follow_user, user_id, int(request['user_id']))
+
+    async def retweet(self, session, request):
+        """
+        Retweets tid, returns False if the session user had already retweeted it
+        """
+        user_id = self.require_login(session)
+        return await self.write(self.store.insert_retweet, user_id, int(request['tid']))
+
+    async def thread(self, session, request):
+        """
+        Returns the tweets tid replies to and the tree of replies under it, page_size replies per tweet
+        down to depth levels
+        """
+        depth = int(request.get('depth', 3))
+        breadth = self.page_size(request)
+        # Every level loads breadth replies for each tweet of the level above, depth 3 with page_size 10
+        # loads 10 + 100 + 1000. The sum is at least depth, so a deeper request is rejected before summing
+        if (depth < 0 or depth > MAX_THREAD_TWEETS
+                or sum(breadth ** level for level in range(1, depth + 1)) > MAX_THREAD_TWEETS):
+            raise RequestError(f"A thread may load at most {MAX_THREAD_TWEETS} replies, lower depth or page_size")
+
+        thread = await self.run(self.store.get_thread, int(request['tid']), depth=depth, breadth=breadth)
+        return [tweet._asdict() for tweet in thread]
+
+    async def replies(self, session, request):
+        """
+        Returns a page of the replies to tid, oldest first. after is the [tdate, tid] of the last reply
+        already loaded
+        """
+        after = request.get('after')
+        if after is not None and not (isinstance(after, list) and len(after) == 2):
+            raise RequestError("after must be the [tdate, tid] of a reply")
+        replies, next_cursor = await self.run(
+            self.store.get_replies, int(request['tid']),
+            cursor=None if after is None else (int(after[0]), int(after[1])), page_size=self.page_size(request))
+        return {'replies': [reply._asdict() for reply in replies], 'has_next': next_cursor is not None}
+
+    async def trending(self, session, request):
+        """
+        Returns the limit hashtags mentioned by the most tweets over the last hours, 20 over 24 hours by default
+        """
+        hours = int(request.get('hours', 24))
+        if not 0 < hours <= TRENDING_RETENTION_HOURS:
+            raise RequestError(f"hours must be between 1 and {TRENDING_RETENTION_HOURS}")
+        limit = int(request.get('limit', 20))
+        if not 0 < limit <= MAX_PAGE_SIZE:
+            raise RequestError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+
+        trends = await self.run(self.store.get_trending, hours=hours, limit=limit)
+        return [trend._asdict() for trend in trends]
+
+    async def metrics(self, session, request):
+        """
+        Returns the query metrics snapshot, the store must have been opened with metrics
+        """
+        if self.store.metrics is None:
+            raise RequestError("Metrics are not being collected, start the server with --metrics")
+        snapshot = dict(self.store.metrics.snapshot(), caches=self.store.cache_stats())
+        if self.writes is not None:
+            snapshot['writes'] = self.writes.stats()
+        return snapshot
+
+    async def compact(self, interval):
+        """
+        Deletes expired trending counters every interval seconds. A failed compaction is logged and
+        tried again at the next interval
+        """
+        while True:
+            try:
+                await self.write(self.store.compact_trending)
+            except sqlite3.Error:
+                logger.exception("Compacting the trending counters failed")
+            await asyncio.sleep(interval)
+
+    async def serve(self, host='127.0.0.1', port=8291, compact_interval=3600):
+        """
+        Accepts clients until cancelled, compacting the trending counters in the background
+        """
+        compaction = asyncio.create_task(self.compact(compact_interval))
+        server = await asyncio.start_server(self.handle_client, host, port)
+        try:
+            async with server:
+                print(f"Serving on {', '.join(str(sock.getsockname()) for sock in server.sockets)}")
+                await server.serve_forever()
+        finally:
+            compaction.cancel()
+
+    def close(self):
+        """
+        Waits for running store calls to finish and stops the thread pool, then commits queued writes
+        """
+        self.executor.shutdown()
+        if self.writes is not None:
+            self.writes.close()
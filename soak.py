@@ -0,0 +1,234 @@
+import argparse
+import contextlib
+import os
+import sys
+import tempfile
+import tracemalloc
+
+import Tweeter
+import dates
+import datagen
+from store import TweeterStore
+
+
+class SoakFailure(Exception):
+    """
+    Raised when a scripted answer does not fit the screen being shown
+    """
+
+
+def stack_depth():
+    """
+    Returns the number of frames on the callers stack
+    """
+    depth = 0
+    frame = sys._getframe(1)
+    while frame is not None:
+        depth += 1
+        frame = frame.f_back
+    return depth
+
+
+class Prompt:
+    """
+    Stands in for an InquirerPy prompt, execute returns the next scripted answer
+    """
+
+    def __init__(self, session, message, choices=None):
+        self.session = session
+        self.message = message
+        self.choices = choices
+
+    def execute(self):
+        return self.session.answer(self.message, self.choices)
+
+
+class ScriptedSession:
+    """
+    Stands in for InquirerPy's inquirer module. Answers every prompt from a script that logs in,
+    repeats one round through every screen rounds times, then logs out and exits.
+
+    Checks the stack depth of every prompt. A screen shown from the same caller must always be at the
+    same depth, one that is shown deeper later means screens are calling each other rather than returning.
+    """
+
+    def __init__(self, login, round_script, rounds, warmup):
+        '''
+            Parameters:
+                    login (list): Answers that log in and leave the follow feed shown after login
+                    round_script (list): Answers of one round, callables are called with the choice values
+                    rounds (int): How many rounds to run
+                    warmup (int): Rounds run before heap tracing starts
+        '''
+        self.login = list(login)
+        self.logout = ['Logout', 'Exit']
+        self.round_script = round_script
+        self.rounds = rounds
+        self.warmup = warmup
+        self.round = 0
+        self.step = 0
+        self.depths = {}  # (screen, screen that showed it) -> stack depth it is shown at
+        self.prompts = 0
+        self.heap_start = None
+        self.heap_end = None
+
+    def select(self, message, choices, **kwargs):
+        return Prompt(self, message, choices)
+
+    def text(self, message, **kwargs):
+        return Prompt(self, message)
+
+    def secret(self, message, **kwargs):
+        return Prompt(self, message)
+
+    def next_answer(self):
+        """
+        Returns the next scripted answer, moving on to the next round at the end of one
+        """
+        if self.login:
+            return self.login.pop(0)
+        if self.round == self.rounds:
+            return self.logout.pop(0)
+
+        answer = self.round_script[self.step]
+        self.step += 1
+        if self.step == len(self.round_script):
+            self.step = 0
+            self.round += 1
+            if self.round == self.warmup:
+                tracemalloc.start()
+                self.heap_start = tracemalloc.get_traced_memory()[0]
+            elif self.round == self.rounds:
+                self.heap_end = tracemalloc.get_traced_memory()[0]
+        return answer
+
+    def answer(self, message, choices):
+        # Frames above this one are Prompt.execute then the screen showing the prompt
+        screen = sys._getframe(2)
+        key = (screen.f_code.co_name, screen.f_back.f_code.co_name)
+        depth = stack_depth()
+        expected = self.depths.setdefault(key, depth)
+        if depth != expected:
+            raise SoakFailure(f"Round {self.round}: {key[0]} shown from {key[1]} {depth} frames deep, "
+                              f"it was {expected} before")
+        self.prompts += 1
+
+        answer = self.next_answer()
+        if choices is not None:
+            values = [getattr(choice, 'value', choice) for choice in choices]
+            if callable(answer):
+                answer = answer(values)
+            if answer not in values:
+                raise SoakFailure(f"Round {self.round}: {answer!r} is not a choice of {message.strip()!r}")
+        return answer
+
+
+def first_tweet(values):
+    """
+    Picks the first tweet of a list of choices
+    """
+    return next(value for value in values if isinstance(value, int))
+
+
+def last_tweet(values):
+    """
+    Picks the last tweet of a list of choices, in a thread the deepest reply shown
+    """
+    return [value for value in values if isinstance(value, int)][-1]
+
+
+def prepare(path, tweets, seed):
+    """
+    Generates a database and picks a user who tweets, follows others and has followers
+
+    Returns: (user id, their name)
+    """
+    store = TweeterStore(path)
+    try:
+        datagen.generate(store, tweets=tweets, seed=seed)
+        user_id, name = store.conn.execute("""
+            SELECT usr, name FROM users
+            WHERE usr IN (SELECT flwer FROM follows) AND usr IN (SELECT flwee FROM follows)
+              AND usr IN (SELECT writer FROM tweets)
+            ORDER BY usr LIMIT 1;
+        """).fetchone()
+        # A hashtag posted now and replied to, so the trending screen and threads have something to show
+        tid = store.insert_tweet(user_id, dates.now(), "soak test #soak")
+        store.insert_tweet(user_id, dates.now(), "soak test reply #soak", replyto=tid)
+        return user_id, name
+    finally:
+        store.close()
+
+
+def soak(rounds=1500, warmup=100, tweets=2000, seed=0):
+    """
+    Drives Tweeter.run through every screen rounds times with scripted answers
+
+    Returns: ScriptedSession holding the stack depths and heap sizes that were measured
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'soak.db')
+        user_id, name = prepare(path, tweets, seed)
+
+        login = ['Login', str(user_id), 'password', 'x']
+        round_script = [
+            # Feed, a tweet, then from thread to thread, which must reuse the one thread view
+            'Follow Feed', first_tweet, 'thr', last_tweet, 'thr', last_tweet, 'thr', 'x', 'x', 'n', 'x',
+            'Search for tweets', '#soak', first_tweet, 'x', 'n', 'x',
+            'Search for users', name, lambda values: user_id, 's', 'x', 'x', 'x',
+            'List followers', first_tweet, 'x', 'x',
+            'Trending', '#soak', first_tweet, 'x', 'x',
+        ]
+        session = ScriptedSession(login, round_script, rounds, warmup)
+
+        Tweeter.load_ui()
+        Tweeter.inquirer = session
+        Tweeter.clear_console = lambda: None
+        Tweeter.time.sleep = lambda seconds: None
+        tweeter = Tweeter.Tweeter(path)
+        # The screens print to a null device rather than a buffer, which would grow the heap
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            try:
+                tweeter.run()
+            except SystemExit:
+                pass
+            finally:
+                tracemalloc.stop()
+        return session
+
+
+def main(argv=None):
+    """
+    Parses the command line, runs the soak test and exits with status 1 if it failed
+    """
+    parser = argparse.ArgumentParser(
+        description="Drive the interactive program through every screen many times and check that "
+                    "neither the stack nor the heap grows")
+    parser.add_argument('--rounds', type=int, default=1500)
+    parser.add_argument('--warmup', type=int, default=100, help="Rounds run before heap tracing starts")
+    parser.add_argument('--tweets', type=int, default=2000, help="Size of the generated database")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-growth-kb', type=float, default=256,
+                        help="Most the traced heap may grow from the end of the warmup to the last round")
+    args = parser.parse_args(argv)
+    if not 0 < args.warmup < args.rounds:
+        parser.error("--warmup must be between 0 and --rounds")
+
+    try:
+        session = soak(args.rounds, args.warmup, args.tweets, args.seed)
+    except SoakFailure as error:
+        print(error)
+        sys.exit(1)
+
+    growth_kb = (session.heap_end - session.heap_start) / 1024
+    print(f"{args.rounds} rounds, {session.prompts} prompts, deepest {max(session.depths.values())} frames, "
+          f"heap grew {growth_kb:.1f} KiB after the warmup")
+    failed = growth_kb > args.max_growth_kb
+    if failed:
+        print(f"Heap grew by more than {args.max_growth_kb} KiB")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
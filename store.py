@@ -0,0 +1,1584 @@
+import array
+import bisect
+import functools
+import heapq
+import itertools
+import sqlite3
+import threading
+import time
+from typing import NamedTuple
+
+import dates
+import schema
+from cache import LRUCache
+from db import Database
+from hashtags import normalize_hashtag, parse_hashtags
+
+
+class User(NamedTuple):
+    usr: int
+    name: str
+    city: str
+    email: str
+    timezone: float
+
+
+class Follower(NamedTuple):
+    usr: int
+    name: str
+    email: str
+    city: str
+    timezone: float
+    start_date: int
+
+
+class UserStats(NamedTuple):
+    tweets: int
+    following: int
+    followers: int
+
+
+class Tweet(NamedTuple):
+    tid: int
+    text: str
+    tdate: int
+
+
+class ProfileCard(NamedTuple):
+    stats: UserStats
+    recent_tweets: list  # Up to three Tweet rows, newest first
+
+
+class TweetStats(NamedTuple):
+    retweets: int
+    replies: int
+
+
+class FoundTweet(NamedTuple):
+    tid: int
+    text: str
+    tdate: int
+    name: str
+
+
+class FeedItem(NamedTuple):
+    tid: int
+    replyto: int
+    text: str
+    date: int
+    type: str  # 'tweet' or 'retweet'
+    author: int
+
+
+class ThreadTweet(NamedTuple):
+    tid: int
+    replyto: int
+    text: str
+    tdate: int
+    name: str
+    depth: int  # Negative for the tweets replied to, 0 for the tweet the thread was opened on, positive for replies
+    replies: int
+
+
+# SQLite's LOWER(), LIKE and NOCASE only fold the case of ASCII letters
+ASCII_LOWER = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+
+
+class Trend(NamedTuple):
+    term: str
+    count: int  # Tweets mentioning the hashtag
+
+
+# Hours of hashtag counters kept by compact_trending, the longest trending window
+TRENDING_RETENTION_HOURS = 7 * 24
+
+# Most entries kept per follower in the timeline table until rebuild_timeline stores another cap
+DEFAULT_TIMELINE_CAP = 800
+
+# Most hashtags kept ranked in each cached trending window, longer top lists are sorted on each read
+TRENDING_TOP_K = 100
+
+
+class TrendingCounts:
+    """
+    How many tweets mentioned each hashtag over one trending window of hours. Loaded once from the
+    hourly counters, then kept up to date with the tweets committed through the store. The top
+    TRENDING_TOP_K hashtags are kept ranked as counts go up, so reads do not sort every hashtag.
+    """
+    __slots__ = ('first_hour', 'last_hour', 'counts', 'counted', 'ranked', 'ranked_terms', 'lock')
+
+    def __init__(self, first_hour, last_hour, counts, counted=()):
+        '''
+            Parameters:
+                    first_hour (int): First hour in the window, in hours since the Unix epoch
+                    last_hour (int): Last hour in the window
+                    counts (dict): Hashtag term -> # of tweets mentioning it in the window
+                    counted (iterable(int)): tids of tweets still being committed that counts already has
+        '''
+        self.first_hour = first_hour
+        self.last_hour = last_hour
+        self.counts = counts
+        self.counted = set(counted)
+        # (-count, term) of the top hashtags, most mentioned first and ties in term order
+        self.ranked = heapq.nsmallest(TRENDING_TOP_K, ((-count, term) for term, count in counts.items()))
+        self.ranked_terms = {term for count, term in self.ranked}
+        self.lock = threading.Lock()
+
+    def add(self, tid, hour, terms):
+        """
+        Counts a new tweet posted in the given hour that mentions terms, unless the window already has it
+        """
+        if not self.first_hour <= hour <= self.last_hour:
+            return
+        with self.lock:
+            # Each tweet is added once, after it commits, a tweet the load already counted is only dropped
+            if tid in self.counted:
+                self.counted.discard(tid)
+                return
+            for term in terms:
+                count = self.counts.get(term, 0) + 1
+                self.counts[term] = count
+                if term in self.ranked_terms:
+                    del self.ranked[bisect.bisect_left(self.ranked, (1 - count, term))]
+                elif len(self.ranked) == TRENDING_TOP_K and (-count, term) > self.ranked[-1]:
+                    continue
+                else:
+                    self.ranked_terms.add(term)
+                bisect.insort(self.ranked, (-count, term))
+                # A hashtag that moved into the top list pushes the last one out
+                if len(self.ranked) > TRENDING_TOP_K:
+                    self.ranked_terms.discard(self.ranked.pop()[1])
+
+    def top(self, limit):
+        """
+        Returns the limit most mentioned hashtags, most mentioned first and ties in term order
+        """
+        with self.lock:
+            if limit <= TRENDING_TOP_K:
+                ranked = self.ranked[:limit]
+            else:
+                ranked = heapq.nsmallest(limit, ((-count, term) for term, count in self.counts.items()))
+        return [Trend(term, -count) for count, term in ranked]
+
+
+class SearchResults:
+    """
+    Every tid matching one tweet search, in the order they are shown. The tids are kept in an array
+    in reverse, so a new tweet that sorts first is appended rather than inserted.
+    """
+    __slots__ = ('tids', 'newest')
+
+    def __init__(self, tids, newest):
+        '''
+            Parameters:
+                    tids (array): Matching tids, last one shown first
+                    newest (tuple): (tdate, tid) of the first tid shown, None if nothing matched
+        '''
+        self.tids = tids
+        self.newest = newest
+
+    def page(self, offset, page_size):
+        """
+        Returns the tids shown on a page, in the order they are shown
+        """
+        end = len(self.tids) - offset
+        if end <= 0:
+            return []
+        return self.tids[max(0, end - page_size):end][::-1].tolist()
+
+
+class IdAllocator:
+    """
+    Hands out new user and tweet ids. Each process reserves a block of ids at a time by advancing a
+    row of the id_sequences table, so several processes sharing one database never get the same id.
+
+    The reservation is made in the callers transaction and becomes permanent when it commits. Call
+    reset after rolling back so the rolled back block is not handed out.
+    """
+
+    # Table name -> id column of the sequences the allocator manages
+    SEQUENCES = {'users': 'usr', 'tweets': 'tid'}
+
+    def __init__(self, conn, block_size=16):
+        '''
+            Parameters:
+                    conn (Connection): Connection the ids are reserved through
+                    block_size (int): How many ids are reserved at a time
+
+        '''
+        self.conn = conn
+        self.block_size = block_size
+        self.blocks = {}  # Table name -> [next id, end of reserved block)
+        self.lock = threading.Lock()
+
+    def next_id(self, table):
+        """
+        Returns the next unused id for the given table, reserving a new block if needed. Does not commit
+
+        Parameters:
+                table (str): 'users' or 'tweets'
+        """
+        with self.lock:
+            block = self.blocks.get(table)
+            if block is None or block[0] == block[1]:
+                block = self.blocks[table] = self.reserve_block(
+                    table, self.block_size)
+            next_id = block[0]
+            block[0] += 1
+
+        return next_id
+
+    def next_ids(self, table, count):
+        """
+        Reserves count consecutive unused ids for the given table. Does not commit
+
+        Parameters:
+                table (str): 'users' or 'tweets'
+                count (int): How many ids are needed
+
+        Returns: range of the reserved ids
+        """
+        with self.lock:
+            start, end = self.reserve_block(table, count)
+
+        return range(start, end)
+
+    def reserve_block(self, table, size):
+        """
+        Advances the sequence of the given table by size and returns the reserved range
+
+        Parameters:
+                table (str): 'users' or 'tweets'
+                size (int): How many ids to reserve
+
+        Returns: [first id, end of block)
+        """
+        column = self.SEQUENCES[table]
+        self.conn.execute(
+            """INSERT OR IGNORE INTO id_sequences (name, next_id) VALUES (?, 1);""", (table,))
+        # Skip past ids written without the allocator, MAX on the primary key is a single seek
+        end = self.conn.execute(f"""
+            UPDATE id_sequences
+            SET next_id = MAX(next_id, (SELECT COALESCE(MAX({column}), 0) + 1 FROM {table})) + ?
+            WHERE name = ?
+            RETURNING next_id;
+        """, (size, table)).fetchone()[0]
+
+        return [end - size, end]
+
+    def reset(self):
+        """
+        Forgets the reserved blocks, the next id of each table will come from a new block
+        """
+        with self.lock:
+            self.blocks.clear()
+
+
+class TweeterStore:
+    """
+    Every query and write Tweeter makes, with no user interface. Methods take the acting user's id
+    as a parameter rather than keeping a logged in user, so one store can serve many sessions.
+    Queries return lists of the NamedTuple row types above.
+    """
+
+    def __init__(self, target, config=None, metrics=None):
+        '''
+        Creates the target sqlite3 database if it does not already exist and migrates its schema. Then establishes the connections to it and the Cursor object.
+        Queries run on pooled read-only connections, writes go through the single writer connection self.conn.
+
+            Parameters:
+                    target (str): Filename of database that tweeter is being opened on
+                    config (dict): Connection settings, see db.DEFAULT_CONFIG
+                    metrics (metrics.QueryMetrics): Collects the latency of every query, None to not collect
+
+        '''
+        self.db = Database(target, config)
+        self.conn = self.db.writer
+        schema.migrate(self.conn)
+        self.c = self.conn.cursor()
+        self.metrics = metrics
+        if metrics is not None:
+            self.db.metrics = metrics
+            metrics.install(self.db)
+            self.c = metrics.cursor(self.c)
+        self.ids = IdAllocator(self.conn)
+        # Most entries kept per follower in the timeline, stored by rebuild_timeline and read again by every write
+        self.timeline_cap = self.get_setting('timeline_cap', DEFAULT_TIMELINE_CAP)
+        # Fan-out-on-write is enabled for every session once the timeline table has been built,
+        # writes look for the table again until they find it, see check_fanout
+        self.fanout = self.table_exists('timeline')
+        # Tweet and user searches go through the full-text indexes once they have been built
+        self.fts = self.table_exists('tweets_fts')
+        self.user_fts = self.table_exists('users_fts')
+        # User and tweet statistics are read from trigger maintained counters once they have been built
+        self.stats = self.table_exists('user_stats')
+        # Profile cards and tweet statistics are kept until a write changes them or they expire
+        self.card_cache = LRUCache(self.db.config['cache_entries'], self.db.config['cache_ttl'])
+        self.tweet_stats_cache = LRUCache(self.db.config['cache_entries'], self.db.config['cache_ttl'])
+        # Matching tids of recent tweet searches, keyed by (order, hashtags, text keywords)
+        self.search_cache = LRUCache(self.db.config['search_cache_entries'], self.db.config['cache_ttl'])
+        # Hashtag counts of recent trending windows, keyed by (hours, current hour)
+        self.trending_cache = LRUCache(8, self.db.config['cache_ttl'])
+        # Cache updates of the writes in the write queue batch being applied, None outside a batch
+        self.batch = None
+        # tids of tweets written but not yet added to the cached trending windows, see load_trending
+        self.committing = set()
+
+    def table_exists(self, name):
+        """
+        Checks if a table exists in the database
+
+        Parameters:
+                name (str): Name of the table
+
+        Returns: True if the table exists otherwise False
+        """
+        self.c.execute(
+            """SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?;""", (name,))
+        return self.c.fetchone() is not None
+
+    def get_setting(self, name, default=None):
+        """
+        Returns a setting stored in the database for every session, default if it has not been stored
+        """
+        self.c.execute("""SELECT value FROM settings WHERE name = ?;""", (name,))
+        row = self.c.fetchone()
+        return default if row is None else row[0]
+
+    def check_login(self, user_id, password):
+        """
+        Checks if the user id and password pair is in the users table
+
+        Parameters:
+                user_id (int): Entered user id
+                password (str): Entered password
+
+        Returns: True if the pair matches a user otherwise False
+        """
+        row = self.db.fetchone(
+            """SELECT usr FROM users WHERE usr = ? AND pwd = ?;""", (
+                user_id, password)
+        )
+        return row is not None
+
+    def insert_user(self, pwd, name, email, city, timezone):
+        """
+        Inserts a new user into the users table
+            Parameters:
+                    pwd (str): users password
+                    name (str): users name
+                    email (str): users email
+                    city (str): users city
+                    timezone (float): users timezone
+
+            Returns: usr of the new user
+        """
+        insert_sql = '''INSERT INTO users (usr, pwd, name, email, city, timezone) VALUES (?, ?, ?, ?, ?, ?)'''
+        try:
+            user_id = self.ids.next_id('users')
+            self.c.execute(insert_sql, (user_id,
+                                        pwd, name, email, city, timezone))
+            self.commit()
+        except sqlite3.Error:
+            self.rollback()
+            raise
+
+        return user_id
+
+    def commit(self, *updates):
+        """
+        Commits a write, then calls updates, the functions bringing the caches up to date with it.
+        Inside a write queue batch both wait until the whole batch commits.
+
+        Parameters:
+                updates (callable): Called with no arguments once the write is committed
+        """
+        if self.batch is not None:
+            self.batch.extend(updates)
+            return
+
+        self.conn.commit()
+        for update in updates:
+            update()
+
+    def rollback(self):
+        """
+        Rolls back the current transaction along with any id blocks reserved in it. Inside a write
+        queue batch the queue rolls back only the failed write instead.
+        """
+        if self.batch is not None:
+            return
+        self.conn.rollback()
+        self.ids.reset()
+
+    def search_for_user_query(self, keyword, offset=0, page_size=5):
+        """
+        This performs the query used in search_for_users. Users whose name contains the keyword come
+        first sorted by name length, then users whose city but not name contains the keyword sorted by
+        city length. Candidates come from the users_fts trigram index when it has been built.
+
+            Parameters:
+                    keyword (str): Keyword entered by user
+                    offset (int): How many matching users to skip
+                    page_size (int): How many users to return
+
+            Returns: list of up to page_size User rows from result of query
+        """
+        # The trigram tokenizer only indexes substrings of at least 3 characters
+        if self.user_fts and len(keyword) >= 3:
+            candidates = "usr IN (SELECT rowid FROM users_fts WHERE users_fts MATCH ?2)"
+            match = '"' + keyword.replace('"', '""') + '"'
+        else:
+            candidates = "(LOWER(name) LIKE LOWER(?1) OR LOWER(city) LIKE LOWER(?1))"
+            match = None
+
+        return self.db.fetchall(f"""
+            SELECT usr, name, city, email, timezone
+            FROM (
+                SELECT usr, name, city, email, timezone,
+                       CASE WHEN LOWER(name) LIKE LOWER(?1) THEN 0 ELSE 1 END AS name_match
+                FROM users
+                WHERE {candidates}
+            )
+            ORDER BY name_match,
+                     CASE name_match WHEN 0 THEN LENGTH(name) ELSE LENGTH(city) END,
+                     usr
+            LIMIT ?3 OFFSET ?4;
+        """, ('%'+keyword+'%', match, page_size, offset), row_type=User)
+
+    def get_user_statistics(self, user_id):
+        """
+        Gets # of tweets, users being followed and followers for given user
+        Parameters:
+                user_id (int): usr for given user
+
+        Returns: UserStats of
+                tweets (int): # of tweets written by the user
+                following (int): # of users being followed by the user
+                followers (int): # of users following the user
+        """
+        # Read the counters kept by triggers when the stats tables have been built
+        if self.stats:
+            row = self.db.fetchone(
+                "SELECT tweets, following, followers FROM user_stats WHERE usr = ?", (user_id,))
+            return UserStats(0, 0, 0) if row is None else UserStats._make(row)
+
+        # Get number of tweets by the user
+        tweet_count = self.db.fetchone(
+            "SELECT COUNT(*) FROM tweets WHERE writer = ?", (user_id,))[0]
+
+        # Get number of users being followed by the user
+        following_count = self.db.fetchone(
+            "SELECT COUNT(*) FROM follows WHERE flwer = ?", (user_id,))[0]
+
+        # Get number of followers for the user
+        follower_count = self.db.fetchone(
+            "SELECT COUNT(*) FROM follows WHERE flwee = ?", (user_id,))[0]
+
+        return UserStats(tweet_count, following_count, follower_count)
+
+    def get_profile_card(self, user_id):
+        """
+        Gets the statistics and three most recent tweets shown by show_user_info, from the cache when possible
+
+        Parameters:
+                user_id (int): usr for given user
+
+        Returns: ProfileCard of the users UserStats and recent tweets
+        """
+        return self.card_cache.get(user_id, self.load_profile_card)
+
+    def load_profile_card(self, user_id):
+        """
+        Queries the profile card of a user, bypassing the cache
+        """
+        recent_tweets, next_cursor = self.get_user_tweets(user_id, page_size=3)
+        return ProfileCard(self.get_user_statistics(user_id), recent_tweets)
+
+    def get_user_tweets(self, user_id, cursor=None, page_size=5):
+        """
+        Query for see_all_tweets and the recent tweets in show_user_info. Uses keyset pagination
+        like get_follow_feed_tweets, so a page of an account with any number of tweets is one index seek.
+
+        Parameters:
+                user_id (int): Selected users user id
+                cursor (tuple): Opaque cursor returned with the previous page. None for the first page
+                page_size (int): How many tweets to return
+
+        Returns:
+                tweets (list(Tweet)): Tweets on the page, newest first
+                next_cursor (tuple): Cursor for the next page. None if there are no more rows
+        """
+        seek = ''
+        params = [user_id]
+        if cursor is not None:
+            seek = "AND (tdate, tid) < (?, ?)"
+            params.extend(cursor)
+        params.append(page_size)
+
+        tweets = self.db.fetchall(f"""
+        SELECT tid, text, tdate
+        FROM tweets
+        WHERE writer = ? {seek}
+        ORDER BY tdate DESC, tid DESC
+        LIMIT ?;
+        """, params, row_type=Tweet)
+
+        next_cursor = None
+        if len(tweets) == page_size:
+            next_cursor = (tweets[-1].tdate, tweets[-1].tid)
+
+        return tweets, next_cursor
+
+    def get_tweet_statistics(self, tweet_id):
+        """
+        Gets # of retweets and replies for given tweet, from the cache when possible
+        Parameters:
+                tweet_id (int): tid for given tweet
+
+        Returns: TweetStats of
+                retweets (int): # of times given tweet was retweeted
+                replies (int): # of times given tweet was replied to
+        """
+        return self.tweet_stats_cache.get(tweet_id, self.load_tweet_statistics)
+
+    def load_tweet_statistics(self, tweet_id):
+        """
+        Queries the # of retweets and replies for given tweet, bypassing the cache
+        """
+        # Read the counters kept by triggers when the stats tables have been built
+        if self.stats:
+            row = self.db.fetchone(
+                "SELECT retweets, replies FROM tweet_stats WHERE tid = ?", (tweet_id,))
+            return TweetStats(0, 0) if row is None else TweetStats._make(row)
+
+        # Count the number of retweets for the given tweet
+        retweets_count = self.db.fetchone(
+            "SELECT COUNT(*) FROM retweets WHERE tid = ?", (tweet_id,))[0]
+
+        # Count the number of replies for the given tweet
+        replies_count = self.db.fetchone(
+            "SELECT COUNT(*) FROM tweets WHERE replyto = ?", (tweet_id,))[0]
+
+        return TweetStats(retweets_count, replies_count)
+
+    def reply_count_column(self):
+        """
+        Returns the SQL expression for the # of replies to a row of tweets
+        """
+        # Reply counts come from the trigger maintained counters once they have been built
+        if self.stats:
+            return "COALESCE((SELECT replies FROM tweet_stats WHERE tweet_stats.tid = tweets.tid), 0)"
+        return "(SELECT COUNT(*) FROM tweets AS reply WHERE reply.replyto = tweets.tid)"
+
+    def get_thread(self, tweet_id, depth=3, breadth=5, max_ancestors=50):
+        """
+        Query for view_thread. Loads the chain of tweets a tweet replies to and the tree of replies
+        under it in one recursive query. Each tweet in the tree has at most breadth of its replies
+        loaded, oldest first, so a thread with any number of replies loads at most
+        breadth + breadth ** 2 + ... + breadth ** depth replies, plus the tweet and up to max_ancestors
+        tweets it replies to. get_replies loads more of the replies to any one tweet.
+
+        Parameters:
+                tweet_id (int): tid of the tweet the thread is opened on
+                depth (int): Most levels of replies loaded below the tweet
+                breadth (int): Most replies loaded per tweet
+                max_ancestors (int): Most tweets loaded up the chain of tweets replied to
+
+        Returns:
+                thread (list(ThreadTweet)): The tweets replied to from the first one down, the tweet, then its
+                                            replies with each reply followed by the replies to it. Empty if
+                                            the tweet does not exist
+        """
+        rows = self.db.fetchall(f"""
+        WITH RECURSIVE
+            ancestors (tid, replyto, depth) AS (
+                SELECT tid, replyto, 0 FROM tweets WHERE tid = ?1
+                UNION ALL
+                SELECT tweets.tid, tweets.replyto, ancestors.depth - 1
+                FROM ancestors JOIN tweets ON tweets.tid = ancestors.replyto
+                WHERE ancestors.depth > -?4
+            ),
+            -- Each step follows at most breadth replies per tweet, seeking the (replyto, tdate, tid) index
+            descendants (tid, depth) AS (
+                SELECT tid, 0 FROM tweets WHERE tid = ?1
+                UNION ALL
+                SELECT reply.tid, descendants.depth + 1
+                FROM descendants JOIN tweets AS reply ON reply.tid IN (
+                    SELECT tid FROM tweets WHERE replyto = descendants.tid ORDER BY tdate, tid LIMIT ?3
+                )
+                WHERE descendants.depth < ?2
+            ),
+            thread (tid, depth) AS (
+                SELECT tid, depth FROM ancestors
+                UNION ALL
+                SELECT tid, depth FROM descendants WHERE depth > 0
+            )
+        SELECT thread.tid, tweets.replyto, tweets.text, tweets.tdate, users.name, thread.depth,
+               {self.reply_count_column()}
+        FROM thread
+        JOIN tweets ON tweets.tid = thread.tid
+        JOIN users ON users.usr = tweets.writer;
+        """, (tweet_id, depth, breadth, max_ancestors), row_type=ThreadTweet)
+
+        # Put the replies in tree order, each one followed by the replies to it
+        thread = sorted((row for row in rows if row.depth <= 0), key=lambda row: row.depth)
+        replies = {}
+        for row in sorted((row for row in rows if row.depth > 0), key=lambda row: (row.tdate, row.tid)):
+            replies.setdefault(row.replyto, []).append(row)
+        stack = replies.get(tweet_id, [])[::-1]
+        while stack:
+            row = stack.pop()
+            thread.append(row)
+            stack.extend(replies.get(row.tid, [])[::-1])
+
+        return thread
+
+    def get_replies(self, tweet_id, cursor=None, page_size=5):
+        """
+        Query for expanding one branch of view_thread. Pages through the replies to a tweet oldest first
+        with keyset pagination on the (replyto, tdate, tid) index
+
+        Parameters:
+                tweet_id (int): tid of the tweet replied to
+                cursor (tuple): (tdate, tid) of the last reply already shown. None for the first page
+                page_size (int): How many replies to return
+
+        Returns:
+                replies (list(ThreadTweet)): Replies on the page with depth 1
+                next_cursor (tuple): Cursor for the next page. None if there are no more rows
+        """
+        seek = ''
+        params = [tweet_id]
+        if cursor is not None:
+            seek = "AND (tweets.tdate, tweets.tid) > (?, ?)"
+            params.extend(cursor)
+        params.append(page_size)
+
+        replies = self.db.fetchall(f"""
+        SELECT tweets.tid, tweets.replyto, tweets.text, tweets.tdate, users.name, 1,
+               {self.reply_count_column()}
+        FROM tweets
+        JOIN users ON users.usr = tweets.writer
+        WHERE tweets.replyto = ? {seek}
+        ORDER BY tweets.tdate, tweets.tid
+        LIMIT ?;
+        """, params, row_type=ThreadTweet)
+
+        next_cursor = None
+        if len(replies) == page_size:
+            next_cursor = (replies[-1].tdate, replies[-1].tid)
+
+        return replies, next_cursor
+
+    def get_trending(self, hours=24, limit=20):
+        """
+        Query for the trending screen. Finds the hashtags mentioned by the most tweets over the last
+        hours from the hourly counters, the counts are cached and updated as tweets are posted
+
+        Parameters:
+                hours (int): Length of the window counted back from the current hour, at most TRENDING_RETENTION_HOURS
+                limit (int): How many hashtags to return
+
+        Returns:
+                trends (list(Trend)): The most mentioned hashtags, most mentioned first
+        """
+        # The window moves on every hour, which starts a new cache entry
+        return self.trending_cache.get((hours, dates.now() // 3600), self.load_trending).top(limit)
+
+    def load_trending(self, key):
+        """
+        Sums the hourly hashtag counters of one trending window, bypassing the cache
+
+        Parameters:
+                key (tuple): (hours, current hour) of the window
+        """
+        hours, hour = key
+        sql = """
+            SELECT term, SUM(count) FROM hashtag_counts
+            WHERE hour BETWEEN ? AND ?
+            GROUP BY term
+        """
+        # Tweets still being committed are looked up in the same statement, so the window knows which
+        # of them its counts already have when their cache update comes
+        committing = list(self.committing)
+        if committing:
+            sql += f"UNION ALL SELECT NULL, tid FROM tweets WHERE tid IN ({', '.join('?' * len(committing))})"
+        rows = self.db.fetchall(sql + ";", [hour - hours + 1, hour] + committing)
+        counts = {term: count for term, count in rows if term is not None}
+        return TrendingCounts(hour - hours + 1, hour, counts, [tid for term, tid in rows if term is None])
+
+    def compact_trending(self, retention_hours=TRENDING_RETENTION_HOURS):
+        """
+        Deletes the hourly hashtag counters that are older than every trending window
+
+        Parameters:
+                retention_hours (int): Hours of counters kept, counting back from the current hour
+
+        Returns: # of counters deleted
+        """
+        try:
+            self.c.execute("""DELETE FROM hashtag_counts WHERE hour <= ?;""",
+                           (dates.now() // 3600 - retention_hours,))
+            deleted = self.c.rowcount
+            self.commit()
+        except sqlite3.Error:
+            self.rollback()
+            raise
+
+        return deleted
+
+    def insert_retweet(self, user_id, tweet_id):
+        """
+        inserts a retweet to a given tweet into retweets table
+
+        Parameters:
+                user_id (int): User id of the retweeting user
+                tweet_id (int): tid of the tweet being retweeted
+
+        Returns: True if the retweet was inserted, False if user_id had already retweeted tweet_id
+        """
+        currDate = dates.now()
+
+        try:
+            # The primary key turns a repeated retweet into a no-op, RETURNING tells the two apart
+            self.c.execute("""
+                INSERT INTO retweets (usr, tid, rdate) VALUES (?, ?, ?)
+                ON CONFLICT DO NOTHING RETURNING tid;
+            """, (user_id, tweet_id, currDate))
+            if self.c.fetchone() is None:
+                self.commit()
+                return False
+
+            if self.check_fanout():
+                self.fan_out(user_id, currDate, tweet_id, 'retweet')
+            self.commit(functools.partial(self.tweet_stats_cache.invalidate, tweet_id))
+        except sqlite3.Error:
+            self.rollback()
+            raise
+
+        return True
+
+    def follow_user(self, user_id, follow_user_id):
+        """
+        Inserts row into follows with user_id as flwer and follow_user_id as flwee
+
+        Parameters:
+                user_id (int): User id of the following user
+                follow_user_id (int): User id for user being followed
+
+        Returns: True if the follow was inserted, False if user_id was already following follow_user_id
+        """
+        try:
+            self.c.execute("""
+                INSERT INTO follows (flwer, flwee, start_date) VALUES (?, ?, ?)
+                ON CONFLICT DO NOTHING RETURNING flwee;
+            """, (user_id, follow_user_id, dates.now(), ))
+
+            # If the user is already following the selected user
+            if self.c.fetchone() is None:
+                self.commit()
+                return False
+
+            if self.check_fanout():
+                self.backfill_timeline(user_id, follow_user_id)
+            self.commit(functools.partial(self.card_cache.invalidate, user_id, follow_user_id))
+        except sqlite3.Error:
+            self.rollback()
+            raise
+
+        return True
+
+    def insert_tweet(self, writer, tdate, text, replyto=None):
+        """
+        inserts a tweet into the tweets table and all hashtags into mentions and hashtags table
+
+        Parameters:
+                writer (int): User id of tweeting user
+                tdate (int, date or datetime): When the tweet was posted, see dates.to_epoch
+                text (str): tweets text
+                replyto (int): replyto is None if the tweet is not a reply. Otherwise it is tid of tweet being replied to
+
+        Returns: tid of the new tweet
+        """
+        tdate = dates.to_epoch(tdate)
+        hashtag_keywords = parse_hashtags(text)
+        next_tweet_id = None
+        try:
+            next_tweet_id = self.ids.next_id('tweets')
+            self.c.execute("""INSERT INTO tweets (tid, writer, tdate, text, replyto) Values (?, ?, ?, ?, ?);""",
+                           (next_tweet_id, writer, tdate, text, replyto,))
+
+            # Terms already in hashtags are skipped by the primary key, parse_hashtags never repeats a term
+            self.c.executemany("""INSERT INTO hashtags (term) VALUES (?) ON CONFLICT DO NOTHING;""",
+                               [(hashtag,) for hashtag in hashtag_keywords])
+            self.c.executemany("""INSERT INTO mentions (tid, term) VALUES (?, ?) ON CONFLICT DO NOTHING;""",
+                               [(next_tweet_id, hashtag) for hashtag in hashtag_keywords])
+
+            if self.check_fanout():
+                self.fan_out(writer, tdate, next_tweet_id, 'tweet')
+            if hashtag_keywords:
+                # Windows loaded from here on check if they already count the tweet. The invalidation
+                # drops windows whose load started earlier, which could count it and then add it again
+                self.committing.add(next_tweet_id)
+                self.trending_cache.invalidate()
+            self.commit(functools.partial(self.tweet_committed, next_tweet_id, writer, tdate, text, replyto))
+        except sqlite3.Error:
+            self.committing.discard(next_tweet_id)
+            self.rollback()
+            raise
+
+        return next_tweet_id
+
+    def tweet_committed(self, tid, writer, tdate, text, replyto):
+        """
+        Updates the caches a new tweet changes, once it has been committed
+        """
+        self.card_cache.invalidate(writer)
+        if replyto is not None:
+            self.tweet_stats_cache.invalidate(replyto)
+        self.search_cache.update(
+            lambda key, results: self.add_search_result(key, results, tid, tdate, text))
+        terms = parse_hashtags(text)
+        if terms:
+            self.trending_cache.update(lambda key, counts: counts.add(tid, tdate // 3600, terms))
+            self.committing.discard(tid)
+
+    def insert_tweets(self, tweets, chunk_size=1000, progress=None):
+        """
+        Bulk inserts tweets along with their hashtags and mentions. Tweets are written in chunks,
+        each chunk in a single transaction with one executemany per table. Inside a write queue
+        batch every chunk commits with the batch.
+
+        Parameters:
+                tweets (iterable(tuple)): Tweets as (writer, tdate, text, replyto) tuples, tdate as dates.to_epoch takes it
+                chunk_size (int): How many tweets are written per transaction
+                progress (callable): Called after each chunk with the # of tweets inserted so far and the rate in tweets per second
+
+        Returns: # of tweets inserted
+        """
+        tweets = iter(tweets)
+        inserted = 0
+        start = time.perf_counter()
+
+        while True:
+            chunk = list(itertools.islice(tweets, chunk_size))
+            if not chunk:
+                break
+
+            try:
+                tweet_ids = self.ids.next_ids('tweets', len(chunk))
+                tweet_rows = [(tid, writer, dates.to_epoch(tdate), text, replyto)
+                              for tid, (writer, tdate, text, replyto) in zip(tweet_ids, chunk)]
+                mention_rows = [(tid, hashtag)
+                                for tid, writer, tdate, text, replyto in tweet_rows
+                                for hashtag in parse_hashtags(text)]
+
+                self.c.executemany("""INSERT INTO tweets (tid, writer, tdate, text, replyto) VALUES (?, ?, ?, ?, ?);""",
+                                   tweet_rows)
+                self.c.executemany("""INSERT OR IGNORE INTO hashtags VALUES (?);""",
+                                   [(hashtag,) for tid, hashtag in mention_rows])
+                self.c.executemany("""INSERT OR IGNORE INTO mentions VALUES (?, ?);""",
+                                   mention_rows)
+
+                if self.check_fanout():
+                    self.c.executemany("""
+                        INSERT OR IGNORE INTO timeline (flwer, date, tid, type, author)
+                        SELECT flwer, ?2, ?1, 'tweet', ?3 FROM follows WHERE flwee = ?3;
+                    """, [(tid, tdate, writer) for tid, writer, tdate, text, replyto in tweet_rows])
+                    writers = {(writer,) for tid, writer, tdate, text, replyto in tweet_rows}
+                    self.c.execute("""CREATE TEMP TABLE IF NOT EXISTS chunk_writers (usr int PRIMARY KEY);""")
+                    self.c.execute("""DELETE FROM chunk_writers;""")
+                    self.c.executemany("""INSERT INTO chunk_writers VALUES (?);""", writers)
+                    self.c.execute("""
+                        SELECT DISTINCT flwer FROM follows WHERE flwee IN (SELECT usr FROM chunk_writers);
+                    """)
+                    self.trim_timeline([flwer for flwer, in self.c.fetchall()])
+
+                self.commit(functools.partial(self.tweets_committed, chunk))
+            except sqlite3.Error:
+                self.rollback()
+                raise
+
+            inserted += len(chunk)
+            if callable(progress):
+                progress(inserted, inserted / (time.perf_counter() - start))
+
+        return inserted
+
+    def tweets_committed(self, chunk):
+        """
+        Updates the caches a chunk of bulk inserted tweets changes, once it has been committed
+        """
+        self.card_cache.invalidate(*{writer for writer, tdate, text, replyto in chunk})
+        self.tweet_stats_cache.invalidate(
+            *{replyto for writer, tdate, text, replyto in chunk if replyto is not None})
+        self.search_cache.clear()
+        self.trending_cache.clear()
+
+    def search_for_tweets_query(self, hashtag_keywords, text_keywords, page=0, page_size=5, order='date'):
+        """
+        Query for search_for tweets. The first page of a search finds every matching tid once and
+        caches them, later pages of the same search only look up the tweets they show.
+
+        Parameters:
+                hashtag_keywords (list(str)): hashtags being searched for
+                text_keywords (list(str)): text keywords being searched for
+                page (int): current page
+                page_size (int): How many tweets to display per page
+                order (str): 'date' for newest first or 'rank' for best bm25 match first
+
+        Returns:
+            tweets (list(FoundTweet)): Tweets found matching keywords
+        """
+        # Hashtags are stored normalized. Text matching ignores ASCII case, so searches differing only in
+        # case or repeated keywords share results
+        key = (order,
+               tuple(sorted({normalize_hashtag(keyword) for keyword in hashtag_keywords} - {''})),
+               tuple(sorted({keyword.translate(ASCII_LOWER) for keyword in text_keywords})))
+        tids = self.search_cache.get(key, self.load_search_results).page(page * page_size, page_size)
+        if not tids:
+            return []
+
+        tweets = self.db.fetchall(f"""
+        SELECT tweets.tid, text, tdate, name
+        FROM tweets
+        INNER JOIN users ON tweets.writer = users.usr
+        WHERE tweets.tid IN ({', '.join('?' * len(tids))});
+        """, tids, row_type=FoundTweet)
+
+        tweets_by_tid = {tweet.tid: tweet for tweet in tweets}
+        return [tweets_by_tid[tid] for tid in tids if tid in tweets_by_tid]
+
+    def load_search_results(self, key):
+        """
+        Finds every tweet matching a search. Text keywords are matched through the tweets_fts full-text
+        index when it has been built, otherwise every keyword scans tweets with LIKE.
+
+        Parameters:
+                key (tuple): (order, hashtag keywords, text keywords) of the search
+
+        Returns: SearchResults of the matching tids
+        """
+        order, hashtag_keywords, text_keywords = key
+
+        # Each query part returns matching tids with a score, lower scores are better matches
+        query_parts = []
+        params = []
+
+        # The trigram tokenizer only indexes substrings of at least 3 characters
+        fts_keywords = [keyword for keyword in text_keywords
+                        if self.fts and len(keyword) >= 3]
+        like_keywords = [keyword for keyword in text_keywords
+                         if keyword not in fts_keywords]
+
+        if fts_keywords:
+            # rank is the bm25 score of the match, bm25() itself cannot be used inside the UNION
+            query_parts.append(
+                "SELECT rowid AS tid, rank AS score FROM tweets_fts WHERE tweets_fts MATCH ?")
+            params.append(" OR ".join(
+                '"' + keyword.replace('"', '""') + '"' for keyword in fts_keywords))
+
+        for keyword in like_keywords:
+            query_parts.append(
+                "SELECT tid, 0 AS score FROM tweets WHERE LOWER(text) LIKE LOWER(?)")
+            params.append(f'%{keyword}%')
+
+        for keyword in hashtag_keywords:
+            query_parts.append(
+                "SELECT tid, 0 AS score FROM mentions WHERE term = ?")
+            params.append(keyword)
+
+        if not query_parts:
+            return SearchResults(array.array('q'), None)
+
+        combined_query_part = " UNION ALL ".join(query_parts)
+
+        if order == 'rank':
+            order_by = "matches.score, tweets.tdate DESC, tweets.tid DESC"
+        else:
+            order_by = "tweets.tdate DESC, tweets.tid DESC"
+
+        # Combined query
+        rows = self.db.fetchall(f"""
+        SELECT tweets.tid, tweets.tdate
+        FROM (
+            SELECT tid, MIN(score) AS score FROM (
+                {combined_query_part}
+            ) GROUP BY tid
+        ) AS matches
+        INNER JOIN tweets ON tweets.tid = matches.tid
+        INNER JOIN users ON tweets.writer = users.usr
+        ORDER BY {order_by};
+        """, params)
+
+        newest = (rows[0][1], rows[0][0]) if rows else None
+        return SearchResults(array.array('q', (tid for tid, tdate in reversed(rows))), newest)
+
+    def add_search_result(self, key, results, tid, tdate, text):
+        """
+        Brings the cached results of one search up to date with a new tweet
+
+        Parameters:
+                key (tuple): (order, hashtag keywords, text keywords) of the search
+                results (SearchResults): Cached results of the search
+                tid (int): tid of the new tweet
+                tdate (int): When the new tweet was posted
+                text (str): Text of the new tweet
+
+        Returns: False if the results can no longer be used and must be dropped
+        """
+        order, hashtag_keywords, text_keywords = key
+        # LIKE treats % and _ as wildcards, so whether those keywords match is not worth working out here
+        if any('%' in keyword or '_' in keyword for keyword in text_keywords):
+            return False
+
+        folded = text.translate(ASCII_LOWER)
+        matches = (any(keyword in folded for keyword in text_keywords) or
+                   any(hashtag in hashtag_keywords for hashtag in parse_hashtags(text)))
+        # The full-text index also folds non-ASCII case, so a match that only differs in that is uncertain
+        lowered = text.lower()
+        uncertain = not matches and any(keyword.lower() in lowered for keyword in text_keywords)
+
+        if uncertain:
+            return False
+        if not matches:
+            return True
+        # A new tweet is only known to be shown first when ordering by date and it is the newest match
+        newest = (tdate, tid)
+        if order != 'date' or (results.newest is not None and newest <= results.newest):
+            return False
+        results.tids.append(tid)
+        results.newest = newest
+        return True
+
+    def build_search_index(self):
+        """
+        Creates the full-text indexes used by search_for_tweets_query and search_for_user_query, the
+        triggers that keep them in sync with the tweets and users tables, and indexes the rows already
+        in the database.
+
+        Returns: True if the index was built, False if this SQLite build lacks FTS5
+        """
+        try:
+            self.c.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS tweets_fts
+                USING fts5(text, content='tweets', content_rowid='tid', tokenize='trigram');
+            """)
+            self.c.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS users_fts
+                USING fts5(name, city, content='users', content_rowid='usr', tokenize='trigram');
+            """)
+        except sqlite3.OperationalError:
+            return False
+
+        self.c.executescript("""
+            CREATE TRIGGER IF NOT EXISTS tweets_fts_insert AFTER INSERT ON tweets BEGIN
+                INSERT INTO tweets_fts (rowid, text) VALUES (NEW.tid, NEW.text);
+            END;
+            CREATE TRIGGER IF NOT EXISTS tweets_fts_delete AFTER DELETE ON tweets BEGIN
+                INSERT INTO tweets_fts (tweets_fts, rowid, text) VALUES ('delete', OLD.tid, OLD.text);
+            END;
+            CREATE TRIGGER IF NOT EXISTS tweets_fts_update AFTER UPDATE OF tid, text ON tweets BEGIN
+                INSERT INTO tweets_fts (tweets_fts, rowid, text) VALUES ('delete', OLD.tid, OLD.text);
+                INSERT INTO tweets_fts (rowid, text) VALUES (NEW.tid, NEW.text);
+            END;
+            INSERT INTO tweets_fts (tweets_fts) VALUES ('rebuild');
+
+            CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users BEGIN
+                INSERT INTO users_fts (rowid, name, city) VALUES (NEW.usr, NEW.name, NEW.city);
+            END;
+            CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users BEGIN
+                INSERT INTO users_fts (users_fts, rowid, name, city) VALUES ('delete', OLD.usr, OLD.name, OLD.city);
+            END;
+            CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE OF usr, name, city ON users BEGIN
+                INSERT INTO users_fts (users_fts, rowid, name, city) VALUES ('delete', OLD.usr, OLD.name, OLD.city);
+                INSERT INTO users_fts (rowid, name, city) VALUES (NEW.usr, NEW.name, NEW.city);
+            END;
+            INSERT INTO users_fts (users_fts) VALUES ('rebuild');
+        """)
+        self.conn.commit()
+        self.fts = True
+        self.user_fts = True
+        return True
+
+    def get_followers(self, user_id, cursor=None, page_size=5):
+        """
+        Query for list_followers, one page at a time ordered by the followers user id
+
+        Parameters:
+                user_id (int): User id of the user whose followers are listed
+                cursor (int): Opaque cursor returned with the previous page. None for the first page
+                page_size (int): How many followers to return
+
+        Returns:
+                followers (list(Follower)): Users following user_id and when they started following
+                next_cursor (int): Cursor for the next page. None if there are no more rows
+        """
+        seek = ''
+        params = [user_id]
+        if cursor is not None:
+            seek = "AND flwer > ?"
+            params.append(cursor)
+        params.append(page_size)
+
+        followers = self.db.fetchall(
+            f"""SELECT usr, name, email, city, timezone, start_date FROM users, follows
+            WHERE flwee = ? {seek} AND flwer = usr
+            ORDER BY flwer LIMIT ?;""", params,
+            row_type=Follower)
+
+        next_cursor = None
+        if len(followers) == page_size:
+            next_cursor = followers[-1].usr
+
+        return followers, next_cursor
+
+    def get_follow_feed_tweets(self, user_id, cursor=None, page_size=5):
+        """
+        Query for follow_feed. Uses keyset pagination so every page costs about the same
+        as the first one: rather than skipping rows with OFFSET, each branch of the feed
+        seeks past the last row of the previous page.
+
+        Parameters:
+                user_id (int): User id of the user whose feed is read
+                cursor (tuple): Opaque cursor returned with the previous page. None for the first page
+                page_size (int): How many results to return
+
+        Returns:
+                tweets (list(FeedItem)): Tweets and retweets on the page
+                next_cursor (tuple): Cursor for the next page. None if there are no more rows
+        """
+        if self.fanout:
+            return self.get_timeline_tweets(user_id, cursor=cursor, page_size=page_size)
+
+        # Rows are ordered by (date, id, type, author) descending. The author is part of the
+        # key because several followed users may retweet the same tweet on the same day
+        tweet_seek = retweet_seek = ''
+        params = [user_id]
+        if cursor is not None:
+            tweet_seek = "AND (tweets.tdate, tweets.tid, 'tweet', tweets.writer) < (?, ?, ?, ?)"
+            retweet_seek = "AND (retweets.rdate, retweets.tid, 'retweet', retweets.usr) < (?, ?, ?, ?)"
+            params.extend(cursor)
+        params.append(page_size)
+        params = params * 2 + [page_size]
+
+        tweets = self.db.fetchall(f"""
+            SELECT id, replyto, text, date, type, author FROM (
+                SELECT * FROM (
+                    SELECT tweets.tid AS id, tweets.text, tweets.tdate AS date, 'tweet' AS type, tweets.writer AS author, replyto
+                    FROM tweets
+                    INNER JOIN follows ON tweets.writer = follows.flwee
+                    WHERE follows.flwer = ? {tweet_seek}
+                    ORDER BY date DESC, id DESC, author DESC LIMIT ?
+                )
+                UNION ALL
+                SELECT * FROM (
+                    SELECT tweets.tid AS id, tweets.text, retweets.rdate AS date, 'retweet' AS type, retweets.usr AS author, NULL as replyto
+                    FROM retweets
+                    INNER JOIN tweets ON retweets.tid = tweets.tid
+                    INNER JOIN follows ON retweets.usr = follows.flwee
+                    WHERE follows.flwer = ? {retweet_seek}
+                    ORDER BY date DESC, id DESC, author DESC LIMIT ?
+                )
+            ) ORDER BY date DESC, id DESC, type DESC, author DESC LIMIT ?;
+        """, params, row_type=FeedItem)
+
+        next_cursor = None
+        if len(tweets) == page_size:
+            last = tweets[-1]
+            next_cursor = (last.date, last.tid, last.type, last.author)
+
+        return tweets, next_cursor
+
+    def get_timeline_tweets(self, user_id, cursor=None, page_size=5):
+        """
+        Query for follow_feed when fan-out-on-write is enabled. Reads one indexed range of
+        the operating users timeline instead of joining tweets, retweets and follows.
+
+        Parameters:
+                user_id (int): User id of the user whose feed is read
+                cursor (tuple): Opaque cursor returned with the previous page. None for the first page
+                page_size (int): How many results to return
+
+        Returns:
+                tweets (list(FeedItem)): Tweets and retweets on the page
+                next_cursor (tuple): Cursor for the next page. None if there are no more rows
+        """
+        seek = ''
+        params = [user_id]
+        if cursor is not None:
+            seek = "AND (timeline.date, timeline.tid, timeline.type, timeline.author) < (?, ?, ?, ?)"
+            params.extend(cursor)
+        params.append(page_size)
+
+        tweets = self.db.fetchall(f"""
+            SELECT timeline.tid, CASE WHEN timeline.type = 'tweet' THEN tweets.replyto END,
+                   tweets.text, timeline.date, timeline.type, timeline.author
+            FROM timeline
+            INNER JOIN tweets ON timeline.tid = tweets.tid
+            WHERE timeline.flwer = ? {seek}
+            ORDER BY timeline.date DESC, timeline.tid DESC, timeline.type DESC, timeline.author DESC
+            LIMIT ?;
+        """, params, row_type=FeedItem)
+
+        next_cursor = None
+        if len(tweets) == page_size:
+            last = tweets[-1]
+            next_cursor = (last.date, last.tid, last.type, last.author)
+
+        return tweets, next_cursor
+
+    def check_fanout(self):
+        """
+        Checks if writes have to keep the timeline table current. Until the table is found it is looked
+        for again on every write, so a session opened before rebuild_timeline ran in another session
+        starts fanning out as soon as the table exists. Call after the write's first insert
+
+        A rebuild either committed before the write's transaction started, and the table is found, or
+        commits after it, and the rebuilt timeline already has the write
+
+        The timeline cap is read again with the check, so every write trims to the cap of the last rebuild
+
+        Returns: True if the timeline table exists otherwise False
+        """
+        if not self.fanout:
+            self.fanout = self.table_exists('timeline')
+        if self.fanout:
+            # A rebuild in another session may have stored a new cap
+            self.timeline_cap = self.get_setting('timeline_cap', DEFAULT_TIMELINE_CAP)
+        return self.fanout
+
+    def fan_out(self, author, date, tweet_id, tweet_type):
+        """
+        Pushes a new tweet or retweet into the timeline of every follower of its author. Does not commit
+
+        Parameters:
+                author (int): User id of the writer or retweeting user
+                date (int): When the tweet or retweet was posted
+                tweet_id (int): tid of the tweet
+                tweet_type (str): 'tweet' or 'retweet'
+        """
+        self.c.execute("""
+            INSERT OR IGNORE INTO timeline (flwer, date, tid, type, author)
+            SELECT flwer, ?, ?, ?, ? FROM follows WHERE flwee = ?;
+        """, (date, tweet_id, tweet_type, author, author))
+
+        self.c.execute(
+            """SELECT flwer FROM follows WHERE flwee = ?;""", (author,))
+        self.trim_timeline([flwer for flwer, in self.c.fetchall()])
+
+    def backfill_timeline(self, flwer, flwee):
+        """
+        Copies the most recent tweets and retweets of a newly followed user into the followers timeline. Does not commit
+
+        Parameters:
+                flwer (int): User id of the follower
+                flwee (int): User id of the user being followed
+        """
+        self.c.execute("""
+            INSERT OR IGNORE INTO timeline (flwer, date, tid, type, author)
+            SELECT ?, date, tid, type, author FROM (
+                SELECT * FROM (
+                    SELECT tdate AS date, tid, 'tweet' AS type, writer AS author
+                    FROM tweets WHERE writer = ?
+                    ORDER BY date DESC, tid DESC LIMIT ?
+                )
+                UNION ALL
+                SELECT * FROM (
+                    SELECT rdate AS date, tid, 'retweet' AS type, usr AS author
+                    FROM retweets WHERE usr = ?
+                    ORDER BY date DESC, tid DESC LIMIT ?
+                )
+            );
+        """, (flwer, flwee, self.timeline_cap, flwee, self.timeline_cap))
+        self.trim_timeline([flwer])
+
+    def trim_timeline(self, flwers):
+        """
+        Deletes the oldest timeline entries of the given followers so each keeps at most timeline_cap entries. Does not commit
+
+        Parameters:
+                flwers (list(int)): User ids of the followers whose timelines are trimmed
+        """
+        # The subquery only depends on the bound follower, so it is a single seek per follower
+        self.c.executemany("""
+            DELETE FROM timeline
+            WHERE flwer = ?1 AND (date, tid, type, author) < (
+                SELECT date, tid, type, author FROM timeline WHERE flwer = ?1
+                ORDER BY date DESC, tid DESC, type DESC, author DESC
+                LIMIT 1 OFFSET ?2 - 1
+            );
+        """, [(flwer, self.timeline_cap) for flwer in flwers])
+
+    def rebuild_timeline(self, cap=None):
+        """
+        Creates the timeline table if needed and regenerates it from the tweets, retweets and follows tables.
+        Building the table enables fan-out-on-write for every session opened on the database.
+
+        Parameters:
+                cap (int): Most entries kept per follower, stored for every session. None to keep the stored cap
+        """
+        if cap is not None:
+            self.timeline_cap = cap
+        self.c.execute("""
+            INSERT INTO settings (name, value) VALUES ('timeline_cap', ?)
+            ON CONFLICT DO UPDATE SET value = excluded.value;
+        """, (self.timeline_cap,))
+        self.c.execute("""
+            CREATE TABLE IF NOT EXISTS timeline (
+                flwer int,
+                date int,
+                tid int,
+                type text,
+                author int,
+                PRIMARY KEY (flwer, date, tid, type, author)
+            ) WITHOUT ROWID;
+        """)
+        self.c.execute("""DELETE FROM timeline;""")
+        self.c.execute("""
+            INSERT INTO timeline (flwer, date, tid, type, author)
+            SELECT flwer, date, tid, type, author FROM (
+                SELECT *, ROW_NUMBER() OVER (
+                    PARTITION BY flwer ORDER BY date DESC, tid DESC, type DESC, author DESC
+                ) AS n
+                FROM (
+                    SELECT follows.flwer, tweets.tdate AS date, tweets.tid, 'tweet' AS type, tweets.writer AS author
+                    FROM tweets
+                    INNER JOIN follows ON tweets.writer = follows.flwee
+                    UNION ALL
+                    SELECT follows.flwer, retweets.rdate AS date, retweets.tid, 'retweet' AS type, retweets.usr AS author
+                    FROM retweets
+                    INNER JOIN tweets ON retweets.tid = tweets.tid
+                    INNER JOIN follows ON retweets.usr = follows.flwee
+                )
+            ) WHERE n <= ?;
+        """, (self.timeline_cap,))
+        self.conn.commit()
+        self.fanout = True
+
+    def verify_stats(self, repair=False):
+        """
+        Recomputes the user_stats and tweet_stats counters from the tweets, follows and retweets tables
+        and compares them with the stored counters. When repairing, creates the stats tables and the
+        triggers that keep them exact if they do not exist yet and replaces any wrong counters.
+
+        Parameters:
+                repair (bool): If True the stored counters are replaced with the recomputed ones
+
+        Returns: # of users and tweets whose stored counters were wrong or missing
+        """
+        if repair:
+            self.create_stats_tables()
+
+        # One transaction from computing the expected counters to replacing the stored ones, so every
+        # count is taken from the same snapshot. A repair takes the write lock up front, so no other
+        # session can bump a trigger counter between the recount and the replacement
+        self.c.execute("BEGIN IMMEDIATE;" if repair else "BEGIN;")
+        try:
+            wrong_users, wrong_tweets = self.compare_stats(repair)
+            self.c.execute("""DROP TABLE temp.expected_user_stats;""")
+            self.c.execute("""DROP TABLE temp.expected_tweet_stats;""")
+            self.conn.commit()
+        except sqlite3.Error:
+            self.rollback()
+            raise
+
+        if repair and (wrong_users or wrong_tweets):
+            self.clear_caches()
+        return wrong_users + wrong_tweets
+
+    def compare_stats(self, repair):
+        """
+        Builds the expected counters, counts the users and tweets whose stored counters differ and
+        replaces those when repairing. Runs inside the transaction opened by verify_stats
+
+        Returns: (# of wrong users, # of wrong tweets)
+        """
+        # Rows with every counter at zero are the same as missing rows
+        self.c.execute("""DROP TABLE IF EXISTS temp.expected_user_stats;""")
+        self.c.execute("""
+            CREATE TEMP TABLE expected_user_stats AS
+            SELECT ids.usr, COALESCE(t.n, 0) AS tweets, COALESCE(f1.n, 0) AS following, COALESCE(f2.n, 0) AS followers
+            FROM (SELECT writer AS usr FROM tweets UNION SELECT flwer FROM follows UNION SELECT flwee FROM follows) AS ids
+            LEFT JOIN (SELECT writer, COUNT(*) AS n FROM tweets GROUP BY writer) AS t ON t.writer = ids.usr
+            LEFT JOIN (SELECT flwer, COUNT(*) AS n FROM follows GROUP BY flwer) AS f1 ON f1.flwer = ids.usr
+            LEFT JOIN (SELECT flwee, COUNT(*) AS n FROM follows GROUP BY flwee) AS f2 ON f2.flwee = ids.usr;
+        """)
+        self.c.execute("""DROP TABLE IF EXISTS temp.expected_tweet_stats;""")
+        self.c.execute("""
+            CREATE TEMP TABLE expected_tweet_stats AS
+            SELECT ids.tid, COALESCE(r.n, 0) AS retweets, COALESCE(p.n, 0) AS replies
+            FROM (SELECT tid FROM retweets UNION SELECT replyto FROM tweets WHERE replyto IS NOT NULL) AS ids
+            LEFT JOIN (SELECT tid, COUNT(*) AS n FROM retweets GROUP BY tid) AS r ON r.tid = ids.tid
+            LEFT JOIN (SELECT replyto, COUNT(*) AS n FROM tweets WHERE replyto IS NOT NULL GROUP BY replyto) AS p ON p.replyto = ids.tid;
+        """)
+
+        self.c.execute("""
+            SELECT COUNT(DISTINCT usr) FROM (
+                SELECT * FROM (
+                    SELECT * FROM expected_user_stats
+                    EXCEPT SELECT * FROM user_stats WHERE tweets OR following OR followers
+                )
+                UNION ALL
+                SELECT * FROM (
+                    SELECT * FROM user_stats WHERE tweets OR following OR followers
+                    EXCEPT SELECT * FROM expected_user_stats
+                )
+            );
+        """)
+        wrong_users = self.c.fetchone()[0]
+
+        self.c.execute("""
+            SELECT COUNT(DISTINCT tid) FROM (
+                SELECT * FROM (
+                    SELECT * FROM expected_tweet_stats
+                    EXCEPT SELECT * FROM tweet_stats WHERE retweets OR replies
+                )
+                UNION ALL
+                SELECT * FROM (
+                    SELECT * FROM tweet_stats WHERE retweets OR replies
+                    EXCEPT SELECT * FROM expected_tweet_stats
+                )
+            );
+        """)
+        wrong_tweets = self.c.fetchone()[0]
+
+        if repair and (wrong_users or wrong_tweets):
+            self.c.execute("""DELETE FROM user_stats;""")
+            self.c.execute("""INSERT INTO user_stats SELECT * FROM expected_user_stats;""")
+            self.c.execute("""DELETE FROM tweet_stats;""")
+            self.c.execute("""INSERT INTO tweet_stats SELECT * FROM expected_tweet_stats;""")
+        return wrong_users, wrong_tweets
+
+    def create_stats_tables(self):
+        """
+        Creates the user_stats and tweet_stats counter tables and the triggers on tweets, follows and
+        retweets that keep them exact. The counters start empty, verify_stats fills them in.
+        """
+        self.c.executescript("""
+            CREATE TABLE IF NOT EXISTS user_stats (
+                usr int PRIMARY KEY,
+                tweets int NOT NULL DEFAULT 0,
+                following int NOT NULL DEFAULT 0,
+                followers int NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS tweet_stats (
+                tid int PRIMARY KEY,
+                retweets int NOT NULL DEFAULT 0,
+                replies int NOT NULL DEFAULT 0
+            );
+
+            CREATE TRIGGER IF NOT EXISTS user_stats_tweet_insert AFTER INSERT ON tweets BEGIN
+                INSERT INTO user_stats (usr, tweets) VALUES (NEW.writer, 1)
+                ON CONFLICT (usr) DO UPDATE SET tweets = tweets + 1;
+                INSERT INTO tweet_stats (tid, replies) SELECT NEW.replyto, 1 WHERE NEW.replyto IS NOT NULL
+                ON CONFLICT (tid) DO UPDATE SET replies = replies + 1;
+            END;
+            CREATE TRIGGER IF NOT EXISTS user_stats_tweet_delete AFTER DELETE ON tweets BEGIN
+                UPDATE user_stats SET tweets = tweets - 1 WHERE usr = OLD.writer;
+                UPDATE tweet_stats SET replies = replies - 1 WHERE tid = OLD.replyto;
+            END;
+            CREATE TRIGGER IF NOT EXISTS user_stats_tweet_update AFTER UPDATE OF writer, replyto ON tweets BEGIN
+                UPDATE user_stats SET tweets = tweets - 1 WHERE usr = OLD.writer;
+                UPDATE tweet_stats SET replies = replies - 1 WHERE tid = OLD.replyto;
+                INSERT INTO user_stats (usr, tweets) VALUES (NEW.writer, 1)
+                ON CONFLICT (usr) DO UPDATE SET tweets = tweets + 1;
+                INSERT INTO tweet_stats (tid, replies) SELECT NEW.replyto, 1 WHERE NEW.replyto IS NOT NULL
+                ON CONFLICT (tid) DO UPDATE SET replies = replies + 1;
+            END;
+
+            CREATE TRIGGER IF NOT EXISTS user_stats_follow_insert AFTER INSERT ON follows BEGIN
+                INSERT INTO user_stats (usr, following) VALUES (NEW.flwer, 1)
+                ON CONFLICT (usr) DO UPDATE SET following = following + 1;
+                INSERT INTO user_stats (usr, followers) VALUES (NEW.flwee, 1)
+                ON CONFLICT (usr) DO UPDATE SET followers = followers + 1;
+            END;
+            CREATE TRIGGER IF NOT EXISTS user_stats_follow_delete AFTER DELETE ON follows BEGIN
+                UPDATE user_stats SET following = following - 1 WHERE usr = OLD.flwer;
+                UPDATE user_stats SET followers = followers - 1 WHERE usr = OLD.flwee;
+            END;
+            CREATE TRIGGER IF NOT EXISTS user_stats_follow_update AFTER UPDATE OF flwer, flwee ON follows BEGIN
+                UPDATE user_stats SET following = following - 1 WHERE usr = OLD.flwer;
+                UPDATE user_stats SET followers = followers - 1 WHERE usr = OLD.flwee;
+                INSERT INTO user_stats (usr, following) VALUES (NEW.flwer, 1)
+                ON CONFLICT (usr) DO UPDATE SET following = following + 1;
+                INSERT INTO user_stats (usr, followers) VALUES (NEW.flwee, 1)
+                ON CONFLICT (usr) DO UPDATE SET followers = followers + 1;
+            END;
+
+            CREATE TRIGGER IF NOT EXISTS tweet_stats_retweet_insert AFTER INSERT ON retweets BEGIN
+                INSERT INTO tweet_stats (tid, retweets) VALUES (NEW.tid, 1)
+                ON CONFLICT (tid) DO UPDATE SET retweets = retweets + 1;
+            END;
+            CREATE TRIGGER IF NOT EXISTS tweet_stats_retweet_delete AFTER DELETE ON retweets BEGIN
+                UPDATE tweet_stats SET retweets = retweets - 1 WHERE tid = OLD.tid;
+            END;
+            CREATE TRIGGER IF NOT EXISTS tweet_stats_retweet_update AFTER UPDATE OF tid ON retweets BEGIN
+                UPDATE tweet_stats SET retweets = retweets - 1 WHERE tid = OLD.tid;
+                INSERT INTO tweet_stats (tid, retweets) VALUES (NEW.tid, 1)
+                ON CONFLICT (tid) DO UPDATE SET retweets = retweets + 1;
+            END;
+        """)
+        self.stats = True
+
+    def check_query_plans(self):
+        """
+        Runs every query Tweeter uses through EXPLAIN QUERY PLAN with sample parameters. The statements
+        are captured with a trace callback while the query methods run, so the check always sees the
+        SQL the methods really execute for the indexes built on this database.
+
+        Raises: schema.QueryPlanError if any of the queries scans a whole table
+        """
+        statements = []
+        previous_callback = self.db.trace_callback
+        self.db.set_trace_callback(statements.append)
+        try:
+            self.check_login(1, 'password')
+            self.search_for_user_query('keyword')
+            self.get_user_statistics(1)
+            self.get_user_tweets(1)
+            self.get_user_tweets(1, cursor=(946684800, 1))
+            self.get_tweet_statistics(1)
+            self.search_for_tweets_query(['hashtag'], ['keyword'])
+            self.get_followers(1)
+            self.get_followers(1, cursor=1)
+            self.get_thread(1)
+            self.load_trending((24, 0))
+            self.get_replies(1, cursor=(946684800, 1))
+            self.get_follow_feed_tweets(1)
+            self.get_follow_feed_tweets(1, cursor=(946684800, 1, 'tweet', 1))
+            # The write paths that look rows up, rolled back afterwards
+            self.ids.reserve_block('tweets', 1)
+            if self.fanout:
+                self.fan_out(1, 946684800, 1, 'tweet')
+                self.backfill_timeline(1, 2)
+        finally:
+            self.db.set_trace_callback(previous_callback)
+            self.rollback()
+
+        queries = [statement for statement in statements
+                   if statement.lstrip().upper().startswith(('SELECT', 'INSERT', 'UPDATE', 'DELETE'))]
+        schema.check_query_plans(self.conn, queries)
+
+    def clear_caches(self):
+        """
+        Drops every cached profile card and tweet statistic, for writes that bypass the store methods
+        """
+        self.card_cache.clear()
+        self.tweet_stats_cache.clear()
+        self.search_cache.clear()
+        self.trending_cache.clear()
+
+    def cache_stats(self):
+        """
+        Returns the hit, miss, eviction and invalidation counters of each cache
+        """
+        return {'profile_cards': self.card_cache.stats(), 'tweet_stats': self.tweet_stats_cache.stats(),
+                'searches': self.search_cache.stats(), 'trending': self.trending_cache.stats()}
+
+    def close(self):
+        """
+        Commits any pending writes and closes every connection to the database
+        """
+        self.db.close()
@@ -0,0 +1,240 @@
+import concurrent.futures
+import queue
+import threading
+import time
+
+
+# Durability modes, see WriteQueue
+DURABILITY = ('immediate', 'grouped', 'relaxed')
+
+# synchronous pragma the writer connection uses in each durability mode, None keeps the configured one.
+# In WAL mode synchronous=normal does not sync the log on commit, a power loss can lose the last commits
+SYNCHRONOUS = {'immediate': 'full', 'grouped': 'full', 'relaxed': None}
+
+# Upper bounds of the batch size histogram buckets, the last bucket takes every larger batch
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+class WriteQueue:
+    """
+    Applies store writes on a single writer thread, grouping the writes queued while the previous
+    batch was committing into one transaction, so a burst of posts pays for one commit rather than
+    one each. Callers get a Future for each write.
+
+    Each write runs inside its own savepoint, a write that fails is rolled back on its own and the
+    rest of its batch still commits. New user and tweet ids are reserved inside the batch transaction.
+
+    Durability modes:
+        immediate: every write is committed on its own before its Future completes
+        grouped: writes are committed in batches, a Future completes once its batch has committed
+        relaxed: writes are committed in batches, a Future completes as soon as its write has been applied.
+                 A crash before the batch commits loses writes that were already acknowledged
+
+    immediate and grouped run the writer with synchronous=full, so a commit is on disk before the
+    Futures of its writes complete. relaxed keeps the configured synchronous setting, normal by default,
+    where a power loss can also lose the last committed batches.
+    """
+
+    def __init__(self, store, durability='grouped', max_batch=64, max_delay=0.002):
+        '''
+        Starts the writer thread
+
+            Parameters:
+                    store (TweeterStore): Store the writes are made through
+                    durability (str): 'immediate', 'grouped' or 'relaxed'
+                    max_batch (int): Most writes committed in one transaction
+                    max_delay (float): Seconds a batch waits for more writes after its first one, 0 to only
+                                       batch the writes queued while the previous batch was committing
+        '''
+        if durability not in DURABILITY:
+            raise ValueError(f"durability must be one of {', '.join(DURABILITY)}")
+        self.store = store
+        self.durability = durability
+        self.max_batch = 1 if durability == 'immediate' else max_batch
+        self.max_delay = max_delay
+        # The setting the writer had before, put back when the queue closes
+        self.previous_synchronous = None
+        if SYNCHRONOUS[durability] is not None:
+            with store.db.write_lock:
+                self.previous_synchronous = store.conn.execute("PRAGMA synchronous;").fetchone()[0]
+                # PRAGMA does not take parameters, the value comes from SYNCHRONOUS
+                store.conn.execute(f"PRAGMA synchronous = {SYNCHRONOUS[durability]};")
+        self.queue = queue.Queue()
+        self.closed = False
+        self.lock = threading.Lock()
+        # Batch size histogram, commit timings and write counters
+        self.batch_counts = [0] * (len(BATCH_BUCKETS) + 1)
+        self.batches = 0
+        self.writes = 0
+        self.failed = 0
+        self.largest_batch = 0
+        self.commit_seconds = 0.0
+        self.slowest_commit = 0.0
+        self.wait_seconds = 0.0
+        self.thread = threading.Thread(target=self.run, name='tweeter-writer', daemon=True)
+        self.thread.start()
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Queues a call to a store write method
+
+        Parameters:
+                function (callable): Store method making the write, e.g. store.insert_tweet
+                args, kwargs: Arguments it is called with
+
+        Returns: Future of the methods return value
+        """
+        future = concurrent.futures.Future()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("The write queue has been closed")
+            self.queue.put((time.perf_counter(), future, function, args, kwargs))
+        return future
+
+    def run(self):
+        """
+        Writer thread, applies batches of queued writes until the queue is closed
+        """
+        while True:
+            write = self.queue.get()
+            if write is None:
+                return
+            batch = [write]
+            deadline = time.monotonic() + self.max_delay
+
+            while len(batch) < self.max_batch:
+                try:
+                    write = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if write is None:
+                    # Closing, commit what has been collected then stop
+                    self.write_batch(batch)
+                    return
+                batch.append(write)
+
+            self.write_batch(batch)
+
+    def write_batch(self, batch):
+        """
+        Applies a batch of writes in one transaction and completes their Futures
+
+        Parameters:
+                batch (list(tuple)): (queued time, Future, function, args, kwargs) of each write
+        """
+        store = self.store
+        conn = store.conn
+        started = time.perf_counter()
+        # Writes applied so far and their return values, completed once the batch commits
+        applied = []
+
+        with store.db.write_lock:
+            store.batch = updates = []
+            # Tweets written by the batch are added to store.committing, see TweeterStore.load_trending
+            committing_tids = set(store.committing)
+            try:
+                conn.execute("BEGIN IMMEDIATE;")
+                for queued, future, function, args, kwargs in batch:
+                    # Cancelled writes are dropped
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    conn.execute("SAVEPOINT queued_write;")
+                    queued_updates = len(updates)
+                    try:
+                        result = function(*args, **kwargs)
+                    except Exception as error:
+                        # sqlite3 may have rolled back the whole transaction, then the batch fails
+                        if not conn.in_transaction:
+                            raise
+                        conn.execute("ROLLBACK TO queued_write;")
+                        conn.execute("RELEASE queued_write;")
+                        # So are the cache updates it queued, e.g. for the chunks insert_tweets wrote before failing
+                        del updates[queued_updates:]
+                        # Ids reserved by the failed write were rolled back with it
+                        store.ids.reset()
+                        future.set_exception(error)
+                        self.failed += 1
+                        continue
+
+                    conn.execute("RELEASE queued_write;")
+                    applied.append((future, result))
+                    if self.durability == 'relaxed':
+                        future.set_result(result)
+
+                committing = time.perf_counter()
+                conn.commit()
+                committed = time.perf_counter()
+            except Exception as error:
+                store.batch = None
+                store.rollback()
+                # The cache updates that would have taken the batch's tweets out of committing never run
+                store.committing.intersection_update(committing_tids)
+                # Nothing in the batch was committed
+                for queued, future, function, args, kwargs in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                        self.failed += 1
+                return
+            finally:
+                store.batch = None
+
+        for update in updates:
+            update()
+        for future, result in applied:
+            if not future.done():
+                future.set_result(result)
+        self.record(batch, started, committed - committing)
+
+    def record(self, batch, started, commit_seconds):
+        """
+        Adds a committed batch to the batch size histogram and timings
+        """
+        index = 0
+        while index < len(BATCH_BUCKETS) and len(batch) > BATCH_BUCKETS[index]:
+            index += 1
+        self.batch_counts[index] += 1
+        self.batches += 1
+        self.writes += len(batch)
+        self.largest_batch = max(self.largest_batch, len(batch))
+        self.commit_seconds += commit_seconds
+        self.slowest_commit = max(self.slowest_commit, commit_seconds)
+        self.wait_seconds += sum(started - queued for queued, future, function, args, kwargs in batch)
+
+    def stats(self):
+        """
+        Returns the batch size histogram, commit timings and write counters as a JSON serializable dict.
+        Bucket counts are cumulative
+        """
+        cumulative = []
+        running = 0
+        for bound, count in zip(BATCH_BUCKETS + ('+Inf',), self.batch_counts):
+            running += count
+            cumulative.append([bound, running])
+        return {
+            'durability': self.durability,
+            'queued': self.queue.qsize(),
+            'batches': self.batches,
+            'writes': self.writes,
+            'failed': self.failed,
+            'mean_batch_size': self.writes / self.batches if self.batches else 0.0,
+            'largest_batch': self.largest_batch,
+            'commit_seconds': self.commit_seconds,
+            'slowest_commit_seconds': self.slowest_commit,
+            'queue_wait_seconds': self.wait_seconds,
+            'batch_sizes': cumulative,
+        }
+
+    def close(self):
+        """
+        Commits the writes still queued and stops the writer thread
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.queue.put(None)
+        self.thread.join()
+        if self.previous_synchronous is not None:
+            with self.store.db.write_lock:
+                # PRAGMA does not take parameters, the value was read from the pragma
+                self.store.conn.execute(f"PRAGMA synchronous = {int(self.previous_synchronous)};")